@@ -19,43 +19,390 @@ limitations under the License.
 
 from ctypes import windll
 import types
+import bisect
+import fnmatch
+import gzip
+import hashlib
+import json
+import math
+import mmap
 import os
-import pickle
 import PIL
 import re
 import shutil
 import string
 import subprocess
+import threading
 import time
-from collections import Counter
-from difflib import get_close_matches
+import zlib
+from collections import Counter, deque
+from difflib import SequenceMatcher
 from distutils.log import warn
 from functools import wraps
+from itertools import count, islice
 from math import sqrt
+from multiprocessing import Pool, cpu_count
+from multiprocessing.pool import ThreadPool
+try:
+    from os import scandir
+except ImportError:
+    from scandir import scandir
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+try:
+    from Queue import Queue
+except ImportError:
+    from queue import Queue
+
+#perf_counter is monotonic and high resolution (Python 3.3+); on older
+#versions, time.clock is the high resolution wall clock on Windows
+clock = getattr(time, 'perf_counter', None)
+if clock is None:
+    clock = time.clock if os.name == 'nt' else time.time
+
+HISTOGRAM_MIN = 1e-6
+HISTOGRAM_GROWTH = 1.1
+HISTOGRAM_BUCKETS = 256
+
+#every Profiled callable by "module.name", see profile_report
+PROFILED = {}
+PROFILING = (os.environ.get('WIN7OOLS_PROFILE', '1').lower()
+             not in ['0', 'false', 'off', 'no'])
+
+def set_profiling(enabled=True):
+    '''
+    Enable or disable Profiled.  While disabled, functions that are
+    already decorated (such as find) call the function directly without
+    recording anything, and Profiled returns functions decorated later
+    unchanged.  Set the WIN7OOLS_PROFILE environment variable to 0 to
+    disable it before win7ools is imported, so there is no wrapper at all.
+    '''
+    global PROFILING
+    PROFILING = enabled
+
+MEMORY_PROFILING = False
+_tracemalloc = None
+
+def set_memory_profiling(enabled=True, frames=1):
+    '''
+    Enable or disable recording of memory allocated by Profiled functions
+    (set the WIN7OOLS_PROFILE_MEMORY environment variable to 1 to enable
+    it at import).  Uses tracemalloc, started with frames frames per
+    traceback; without tracemalloc (Python < 3.4) memory profiling stays
+    disabled.  Return True if memory profiling is enabled.
+    Tracing allocations slows Python down considerably, and peaks of
+    nested or concurrent calls are approximate.  Peaks need
+    tracemalloc.reset_peak (Python 3.9+); before that only net bytes and
+    allocation sites are recorded.
+    '''
+    global MEMORY_PROFILING, _tracemalloc
+    if enabled:
+        try:
+            import tracemalloc
+        except ImportError:
+            warn('tracemalloc is not available, memory profiling is disabled')
+            return False
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(frames)
+        _tracemalloc = tracemalloc
+    elif _tracemalloc is not None and _tracemalloc.is_tracing():
+        _tracemalloc.stop()
+    MEMORY_PROFILING = enabled
+    return MEMORY_PROFILING
+
+if (os.environ.get('WIN7OOLS_PROFILE_MEMORY', '0').lower()
+        in ['1', 'true', 'on', 'yes']):
+    set_memory_profiling()
+
+#finished spans, oldest dropped first, see span and trace_json
+SPANS = deque(maxlen=100000)
+TRACING = (os.environ.get('WIN7OOLS_TRACE', '0').lower()
+           in ['1', 'true', 'on', 'yes'])
+_span_ids = count(1)
+_span_stack = threading.local()
+
+def set_tracing(enabled=True, buffer_size=None):
+    '''
+    Enable or disable recording of spans (set the WIN7OOLS_TRACE
+    environment variable to 1 to enable it at import).  If buffer_size
+    is given, SPANS is replaced by an empty buffer of that many spans.
+    '''
+    global TRACING, SPANS
+    TRACING = enabled
+    if buffer_size is not None:
+        SPANS = deque(maxlen=buffer_size)
+
+class span(object):
+    '''
+    Context manager that records the time spent in its block as a span
+    in SPANS while tracing is enabled (see set_tracing).  Spans opened
+    inside the block, including calls to Profiled functions, are recorded
+    as its children.  args are stored with the span.
+    ex:
+        >> with span('scan', dirpath='D:\\'):
+        >>     get_duplicate_files('D:\\')
+        >> trace_json('scan.json')  #open in chrome://tracing
+    '''
+    def __init__(self, name, **args):
+        self.name = name
+        self.args = args
+        self.id = None
+
+    def __enter__(self):
+        if TRACING:
+            stack = _span_stack.__dict__.setdefault('spans', [])
+            self.parent = stack[-1].id if stack else None
+            self.id = next(_span_ids)
+            stack.append(self)
+            self.start = clock()
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.id is not None:
+            end = clock()
+            _span_stack.spans.pop()
+            SPANS.append({'name': self.name, 'id': self.id,
+                          'parent': self.parent, 'start': self.start,
+                          'end': end, 'args': self.args,
+                          'thread': threading.current_thread().ident})
+            self.id = None
+        return False
+
+def trace_json(filename=''):
+    '''
+    Return spans in SPANS as Chrome trace event JSON (open it in
+    chrome://tracing or Perfetto), also written to filename if given.
+    '''
+    pid = os.getpid()
+    events = []
+    for i in list(SPANS):
+        args = dict((k, str(v)) for k, v in i['args'].items())
+        args.update({'id': i['id'], 'parent': i['parent']})
+        events.append({'name': i['name'], 'cat': 'win7ools', 'ph': 'X',
+                       'ts': i['start'] * 1e6,
+                       'dur': (i['end'] - i['start']) * 1e6,
+                       'pid': pid, 'tid': i['thread'], 'args': args})
+    data = json.dumps({'traceEvents': events, 'displayTimeUnit': 'ms'})
+    if filename:
+        with open(filename, 'w') as f:
+            f.write(data)
+    return data
+
+class Profiled(object):
+    '''
+    Decorator that keeps running statistics of the runtimes of func in
+    constant memory: number of calls, mean and variance (Welford's method),
+    min, max, and a histogram of log-spaced buckets (each HISTOGRAM_GROWTH
+    times wider than the last) for percentiles within 10%.
+    Safe to use on functions called from several threads.
+    Profiled functions are registered in PROFILED (see profile_report),
+    and calls are recorded as spans while tracing is enabled (see span).
+
+    >>> f = Profiled(lambda x: x)
+    >>> [f(i) for i in range(3)]
+    [0, 1, 2]
+    >>> f.called
+    3
+    >>> f.min_runtime <= f.percentile(50) <= f.max_runtime
+    True
+    '''
+    def __new__(cls, func):
+        if not PROFILING:
+            return func
+        return super(Profiled, cls).__new__(cls)
 
-class Profiled:
     def __init__(self, func):
         wraps(func)(self)
-        self.called = 0
-        self.runtimes = []
-        self.average_runtime = 0
-        self.last_run = 0
         self.wrapped = func
+        self.lock = threading.Lock()
+        self.reset()
+        PROFILED['%s.%s'%(func.__module__, func.__name__)] = self
+
     def __call__(self, *args, **kwargs):
-        self.called += 1
-        start = time.time()
-        result = self.wrapped(*args, **kwargs)
-        end = time.time()
-        self.runtimes.append(end - start)
-        self.average_runtime = sum(self.runtimes) / float(self.called)
-        self.last_run = self.runtimes[self.called - 1]
-        return result
+        call = self._call if PROFILING else self.wrapped
+        if TRACING:
+            with span(self.__name__):
+                return call(*args, **kwargs)
+        return call(*args, **kwargs)
+
+    def _call(self, *args, **kwargs):
+        if MEMORY_PROFILING:
+            return self._call_memory(*args, **kwargs)
+        start = clock()
+        try:
+            return self.wrapped(*args, **kwargs)
+        finally:
+            self.record(clock() - start)
+
+    def _call_memory(self, *args, **kwargs):
+        tracemalloc = _tracemalloc
+        ignore = [tracemalloc.Filter(False, tracemalloc.__file__)]
+        before = tracemalloc.take_snapshot().filter_traces(ignore)
+        current = tracemalloc.get_traced_memory()[0]
+        #without reset_peak, the peak is the highest since tracing started
+        has_peak = hasattr(tracemalloc, 'reset_peak')
+        if has_peak:
+            tracemalloc.reset_peak()
+        start = clock()
+        try:
+            return self.wrapped(*args, **kwargs)
+        finally:
+            self.record(clock() - start)
+            after, peak = tracemalloc.get_traced_memory()
+            snapshot = tracemalloc.take_snapshot().filter_traces(ignore)
+            sites = snapshot.compare_to(before, 'lineno')[:10]
+            peak = max(peak - current, 0) if has_peak else None
+            self.record_memory(peak, after - current, sites)
+
     def __get__(self, instance, cls):
         if instance is None:
             return self
         else:
             return types.MethodType(self, instance)
 
+    def reset(self):
+        '''Forget all recorded runtimes.'''
+        with self.lock:
+            self.called = 0
+            self.average_runtime = 0
+            self.last_run = 0
+            self.min_runtime = 0
+            self.max_runtime = 0
+            self.histogram = [0]*HISTOGRAM_BUCKETS
+            self._m2 = 0
+            self.memory_called = 0
+            self.peak_called = 0
+            self.average_peak = 0
+            self.max_peak = 0
+            self.average_net = 0
+            self.allocations = Counter()
+
+    def record(self, runtime):
+        '''Add runtime (in seconds) to the statistics.'''
+        if runtime < HISTOGRAM_MIN:
+            bucket = 0
+        else:
+            bucket = int(math.log(runtime / HISTOGRAM_MIN) /
+                         math.log(HISTOGRAM_GROWTH)) + 1
+            bucket = min(bucket, HISTOGRAM_BUCKETS - 1)
+        with self.lock:
+            self.called += 1
+            delta = runtime - self.average_runtime
+            self.average_runtime += delta / self.called
+            self._m2 += delta * (runtime - self.average_runtime)
+            if self.called == 1 or runtime < self.min_runtime:
+                self.min_runtime = runtime
+            if runtime > self.max_runtime:
+                self.max_runtime = runtime
+            self.last_run = runtime
+            self.histogram[bucket] += 1
+
+    def record_memory(self, peak, net, sites):
+        '''
+        Add peak (None if unknown) and net allocated bytes of a call to the
+        statistics, and the bytes allocated by each site in sites
+        (tracemalloc StatisticDiff list) to allocations.
+        '''
+        with self.lock:
+            self.memory_called += 1
+            n = float(self.memory_called)
+            self.average_net += (net - self.average_net) / n
+            if peak is not None:
+                self.peak_called += 1
+                n = float(self.peak_called)
+                self.average_peak += (peak - self.average_peak) / n
+                self.max_peak = max(self.max_peak, peak)
+            for i in sites:
+                if i.size_diff > 0:
+                    frame = i.traceback[0]
+                    site = '%s:%s'%(frame.filename, frame.lineno)
+                    self.allocations[site] += i.size_diff
+            if len(self.allocations) > 100:
+                top = self.allocations.most_common(50)
+                self.allocations = Counter(dict(top))
+
+    @property
+    def variance(self):
+        return self._m2 / (self.called - 1) if self.called > 1 else 0.0
+
+    @property
+    def stdev(self):
+        return sqrt(self.variance)
+
+    def percentile(self, q):
+        '''
+        Return upper bound of the histogram bucket holding the q-th
+        percentile (0-100) of the runtimes, clamped to min and max.
+        '''
+        with self.lock:
+            target = q / 100.0 * self.called
+            count = 0
+            for bucket, n in enumerate(self.histogram):
+                count += n
+                if n and count >= target:
+                    bound = HISTOGRAM_MIN * HISTOGRAM_GROWTH**bucket
+                    return max(self.min_runtime, min(bound, self.max_runtime))
+            return self.max_runtime
+
+    def stats(self):
+        '''
+        Return dictionary of the statistics, including mean and max peak
+        bytes, mean net bytes and the top allocation sites if memory was
+        recorded (see set_memory_profiling).
+        '''
+        stats = {'called': self.called,
+                'total': self.called * self.average_runtime,
+                'mean': self.average_runtime,
+                'stdev': self.stdev, 'min': self.min_runtime,
+                'max': self.max_runtime, 'p50': self.percentile(50),
+                'p95': self.percentile(95), 'p99': self.percentile(99)}
+        if self.memory_called:
+            stats.update({'net_bytes': self.average_net,
+                          'allocations': self.allocations.most_common(5)})
+        if self.peak_called:
+            stats.update({'peak_bytes': self.average_peak,
+                          'max_peak_bytes': self.max_peak})
+        return stats
+
+def profile_report():
+    '''Return dictionary of name: Profiled.stats() for every called function.'''
+    return dict((k, v.stats()) for k, v in PROFILED.items() if v.called)
+
+def profile_json(filename=''):
+    '''Return profile_report as JSON, also written to filename if given.'''
+    data = json.dumps(profile_report(), indent=2, sort_keys=True)
+    if filename:
+        with open(filename, 'w') as f:
+            f.write(data)
+    return data
+
+def profile_table(sort_by='total'):
+    '''
+    Return profile_report as a text table sorted by sort_by, in descending
+    order.  Times are in milliseconds and memory in kilobytes.
+    '''
+    columns = ['called', 'total', 'mean', 'stdev', 'min', 'max',
+               'p50', 'p95', 'p99']
+    memory = ['peak_bytes', 'max_peak_bytes', 'net_bytes']
+    report = sorted(profile_report().items(),
+                    key=lambda x: x[1].get(sort_by, 0), reverse=True)
+    if any('net_bytes' in v for k, v in report):
+        columns += memory
+    width = max([len('function')] + [len(k) for k, v in report])
+    lines = ['%-*s'%(width, 'function') +
+             ''.join('%12s'%x.replace('_bytes', '_kb') for x in columns)]
+    for name, stats in report:
+        line = '%-*s%12d'%(width, name, stats['called'])
+        for x in columns[1:]:
+            if x in memory:
+                line += '%12.1f'%(stats[x]/1024.0) if x in stats else ' '*12
+            else:
+                line += '%12.3f'%(stats[x]*1000)
+        lines.append(line)
+    return '\n'.join(lines)
+
 def is_hidden(path):
     return bool(windll.kernel32.GetFileAttributesW(unicode(path)) & 2)
 
@@ -185,25 +532,307 @@ def hamming_distance(strA, strB):
     else:
         warn('Input strings are not the same length.')
 
+def bit_distance(a, b):
+    '''
+    Calculate the Hamming distance of two integers (number of differing bits).
+    Used to compare packed hashes such as those returned by sec.phash_int.
+
+    >>> bit_distance(0b1011, 0b1001)
+    1
+    >>> bit_distance(12345, 54321)
+    5
+    '''
+    return bin(a ^ b).count('1')
+
+class BKTree(object):
+    '''
+    Burkhard-Keller tree of items under a metric distance function.
+    Finding all items within a radius of a query only visits the subtrees
+    that can contain them, rather than comparing every item.
+
+    >>> tree = BKTree([0b0000, 0b0001, 0b0111, 0b1111])
+    >>> len(tree)
+    4
+    >>> sorted(tree.query(0b0011, 1))
+    [(1, 1), (1, 7)]
+    '''
+    def __init__(self, items=(), distance=bit_distance):
+        self.distance = distance
+        self.root = None
+        self.size = 0
+        for item in items:
+            self.add(item)
+
+    def __len__(self):
+        return self.size
+
+    def add(self, item):
+        '''Add item to the tree.'''
+        node = (item, {})
+        self.size += 1
+        if self.root is None:
+            self.root = node
+            return self
+        value, children = self.root
+        while True:
+            d = self.distance(item, value)
+            if d in children:
+                value, children = children[d]
+            else:
+                children[d] = node
+                return self
+
+    def query(self, item, radius):
+        '''Return list of (distance, value) for values within radius of item.'''
+        found = []
+        nodes = [self.root] if self.root is not None else []
+        while nodes:
+            value, children = nodes.pop()
+            d = self.distance(item, value)
+            if d <= radius:
+                found.append((d, value))
+            for k, child in children.items():
+                if d - radius <= k <= d + radius:
+                    nodes.append(child)
+        return found
+
 def tanimoto():
     return 0
 
-def levenshtein():
-    return 0
+def _myers(pattern, text):
+    '''
+    Return edit distance of pattern and text with Myers' bit-parallel
+    algorithm (in Hyyro's form for edit distance), one column per
+    character of text.  Python integers have no fixed width, so patterns
+    longer than a machine word work too, only slower.
+    '''
+    m = len(pattern)
+    if not m:
+        return len(text)
+    peq = {}
+    for i, c in enumerate(pattern):
+        peq[c] = peq.get(c, 0) | (1 << i)
+    mask = (1 << m) - 1
+    high = 1 << (m - 1)
+    pv, mv, score = mask, 0, m
+    for c in text:
+        eq = peq.get(c, 0)
+        xv = eq | mv
+        xh = ((((eq & pv) + pv) & mask) ^ pv) | eq
+        ph = mv | (~(xh | pv) & mask)
+        mh = pv & xh
+        if ph & high:
+            score += 1
+        elif mh & high:
+            score -= 1
+        ph = ((ph << 1) | 1) & mask
+        mh = (mh << 1) & mask
+        pv = mh | (~(xv | ph) & mask)
+        mv = ph & xv
+    return score
+
+def _banded(a, b, max_distance):
+    '''
+    Return edit distance of a and b, computing only cells within
+    max_distance of the diagonal, or max_distance + 1 as soon as every
+    cell of a row is larger than max_distance.
+    '''
+    k = max_distance
+    if abs(len(a) - len(b)) > k:
+        return k + 1
+    beyond = k + 1
+    previous = [j if j <= k else beyond for j in range(len(b) + 1)]
+    for i in range(1, len(a) + 1):
+        low, high = max(1, i - k), min(len(b), i + k)
+        current = [beyond]*(len(b) + 1)
+        current[0] = i if i <= k else beyond
+        best = current[0]
+        for j in range(low, high + 1):
+            cost = previous[j - 1] + (a[i - 1] != b[j - 1])
+            d = min(previous[j] + 1, current[j - 1] + 1, cost, beyond)
+            current[j] = d
+            if d < best:
+                best = d
+        if best > k:
+            return beyond
+        previous = current
+    return min(previous[len(b)], beyond)
+
+def levenshtein(a, b, max_distance=None):
+    '''
+    Return the edit distance (insertions, deletions and substitutions)
+    between a and b.  If max_distance is given, distances larger than
+    max_distance are returned as max_distance + 1; strings longer than 64
+    characters are then compared with a banded DP that stops as soon as
+    max_distance is exceeded.  Otherwise the bit-parallel algorithm of
+    Myers is used, which handles 64 characters per machine word.
+
+    >>> levenshtein('kitten', 'sitting')
+    3
+    >>> levenshtein('', 'abc')
+    3
+    >>> levenshtein('kitten', 'sitting', max_distance=2)
+    3
+    >>> levenshtein('f' + 'law' * 30, 'law' * 30 + 'n', max_distance=5)
+    2
+    '''
+    if len(a) > len(b):
+        a, b = b, a
+    if max_distance is not None and len(a) > 64:
+        return _banded(a, b, max_distance)
+    distance = _myers(a, b)
+    if max_distance is not None:
+        distance = min(distance, max_distance + 1)
+    return distance
+
+def levenshtein_many(query, items, max_distance=None):
+    '''
+    Return list of levenshtein(query, item, max_distance) for each item.
+    If numpy is available and query has at most 64 characters, Myers'
+    algorithm runs on all items at once, one numpy operation per
+    character position.
+
+    >>> levenshtein_many('kitten', ['sitting', 'kitten', 'mitten', ''])
+    [3, 0, 1, 6]
+    '''
+    items = list(items)
+    try:
+        import numpy
+    except ImportError:
+        numpy = None
+    if not numpy or not items or not 0 < len(query) <= 64:
+        return [levenshtein(query, x, max_distance) for x in items]
+    m = len(query)
+    #query characters and masks of their positions, sorted by code point
+    peq = {}
+    for i, c in enumerate(query):
+        peq[ord(c)] = peq.get(ord(c), 0) | (1 << i)
+    codes = numpy.array(sorted(peq), dtype=numpy.uint32)
+    masks = numpy.array([peq[x] for x in sorted(peq)], dtype=numpy.uint64)
+    text = numpy.array(items)
+    width = text.dtype.itemsize // (4 if text.dtype.kind == 'U' else 1)
+    text = text.view(numpy.uint32 if text.dtype.kind == 'U' else numpy.uint8)
+    text = text.reshape(len(items), width)
+    lengths = numpy.array([len(x) for x in items])
+    one = numpy.uint64(1)
+    mask = numpy.uint64((1 << m) - 1)
+    high = numpy.uint64(1 << (m - 1))
+    pv = numpy.empty(len(items), dtype=numpy.uint64)
+    pv.fill(mask)
+    mv = numpy.zeros(len(items), dtype=numpy.uint64)
+    score = numpy.empty(len(items), dtype=numpy.int64)
+    score.fill(m)
+    for j in range(width):
+        active = lengths > j
+        column = text[:, j].astype(numpy.uint32)
+        position = numpy.minimum(numpy.searchsorted(codes, column),
+                                 len(codes) - 1)
+        eq = numpy.where(codes[position] == column, masks[position],
+                         numpy.uint64(0))
+        xv = eq | mv
+        xh = ((((eq & pv) + pv) & mask) ^ pv) | eq
+        ph = mv | (~(xh | pv) & mask)
+        mh = pv & xh
+        step = (ph & high != 0).astype(numpy.int64)
+        step -= (mh & high != 0).astype(numpy.int64)
+        ph = ((ph << one) | one) & mask
+        mh = (mh << one) & mask
+        score += numpy.where(active, step, 0)
+        pv = numpy.where(active, mh | (~(xv | ph) & mask), pv)
+        mv = numpy.where(active, ph & xv, mv)
+    if max_distance is not None:
+        score = numpy.minimum(score, max_distance + 1)
+    return [int(x) for x in score]
  
+class FuzzyIndex(object):
+    '''
+    Inverted index of the character n-grams of items, for fuzzy lookups.
+    A query only scores items that share n-grams with it: the candidates
+    with the most n-grams in common (by Dice coefficient) are scored with
+    difflib.SequenceMatcher.ratio, the measure get_close_matches uses.
+
+    >>> index = FuzzyIndex(['Mozilla Firefox', 'Google Chrome', 'Opera'])
+    >>> index.best('firefox')
+    'Mozilla Firefox'
+    >>> [item for score, item in index.query('fox chrome', k=2)]
+    ['Google Chrome', 'Mozilla Firefox']
+    '''
+    def __init__(self, items=(), n=3, candidates=50):
+        self.n = n
+        self.candidates = candidates
+        self.items = []
+        self.sizes = []
+        self.index = {}
+        self.add(items)
+
+    def __len__(self):
+        return len(self.items)
+
+    def grams(self, text):
+        '''Return set of n-grams of text, padded so short words have some.'''
+        padded = ' '*(self.n - 1) + text.lower() + ' '
+        count = len(padded) - self.n + 1
+        return set(padded[i:i + self.n] for i in range(count))
+
+    def add(self, items):
+        for item in items:
+            grams = self.grams(item)
+            for gram in grams:
+                self.index.setdefault(gram, []).append(len(self.items))
+            self.items.append(item)
+            self.sizes.append(len(grams))
+
+    def query(self, text, k=1):
+        '''
+        Return list of the k best (score, item), best first.  Ties go to the
+        larger item, like get_close_matches.  If no item shares an n-gram
+        with text, every item is scored.
+        '''
+        grams = self.grams(text)
+        shared = Counter()
+        for gram in grams:
+            shared.update(self.index.get(gram, ()))
+        if shared:
+            dice = lambda i: 2.0 * shared[i] / (len(grams) + self.sizes[i])
+            ids = sorted(shared, key=dice, reverse=True)[:self.candidates]
+        else:
+            ids = range(len(self.items))
+        matcher = SequenceMatcher()
+        matcher.set_seq2(text)
+        scored = []
+        for i in ids:
+            matcher.set_seq1(self.items[i])
+            scored.append((matcher.ratio(), self.items[i]))
+        scored.sort(reverse=True)
+        return scored[:k]
+
+    def best(self, text):
+        '''Return the item closest to text, or None if there are no items.'''
+        found = self.query(text)
+        return found[0][1] if found else None
+
+#FuzzyIndex of the last items passed to get_closest_match
+_closest_index = {}
+
 def get_closest_match(a, items, cutoff=0.9):
     '''
+    Return the item in items closest to a (see FuzzyIndex), or '' if items
+    is empty.  cutoff is ignored; the closest item is always returned.
+    The index is kept for the next call with the same items.
     >>> names = ['joe', 'joel', 'joseph']
     >>> get_closest_match('jo', names)
     'joe'
     >>> get_closest_match('jos', names)
     'joseph'
     '''
-    match = get_close_matches(a, items, 1, cutoff)
-    while not match:
-        match = get_closest_match(a, items, cutoff - 0.01)
-    match = re.sub("[\[\]\'\"]", "", str(match))
-    return match
+    key = tuple(items)
+    index = _closest_index.get(key)
+    if index is None:
+        index = FuzzyIndex(key)
+        _closest_index.clear()
+        _closest_index[key] = index
+    match = index.best(a)
+    return '' if match is None else match
   
 def get_most_frequent(stuff):
     '''
@@ -284,95 +913,888 @@ def readability(text, debug=False):
         print('sentences: %i'%sentences)
     return round(float(ARI + CLI + SMOG) / 3, 2)
 
-def copy(src, dst, overwrite_older=True):
+def _copy_file(args):
+    '''
+    Copy file src to dst, replacing dst, and copy its timestamps and mode.
+    os.copy_file_range or os.sendfile are used when the platform has them,
+    so the data does not pass through Python.  Return number of bytes copied.
+    '''
+    src, dst = args
+    if os.path.exists(dst):
+        os.remove(dst)
+    with open(src, 'rb') as fsrc:
+        with open(dst, 'wb') as fdst:
+            size = os.fstat(fsrc.fileno()).st_size
+            copied = 0
+            for name in ['copy_file_range', 'sendfile']:
+                kernel_copy = getattr(os, name, None)
+                if kernel_copy is None or copied == size:
+                    continue
+                try:
+                    #sendfile writes at the position of dst, so continue
+                    #where the previous method stopped
+                    os.lseek(fdst.fileno(), copied, os.SEEK_SET)
+                    while copied < size:
+                        if name == 'sendfile':
+                            n = kernel_copy(fdst.fileno(), fsrc.fileno(),
+                                            copied, size - copied)
+                        else:
+                            n = kernel_copy(fsrc.fileno(), fdst.fileno(),
+                                            size - copied, copied, copied)
+                        if not n:
+                            break
+                        copied += n
+                except OSError:
+                    copied = 0
+            if copied != size:
+                fsrc.seek(0)
+                fdst.seek(0)
+                fdst.truncate()
+                shutil.copyfileobj(fsrc, fdst, 1024*1024)
+    shutil.copystat(src, dst)
+    return size
+
+def block_signatures(pathName, block_size=64*1024):
+    '''
+    Return list of (weak, strong) checksums for each block of file pathName,
+    where weak is the adler32 and strong the md5 digest of the block.
+    '''
+    signatures = []
+    with open(pathName, 'rb') as f:
+        block = f.read(block_size)
+        while block:
+            signatures.append((zlib.adler32(block), hashlib.md5(block).digest()))
+            block = f.read(block_size)
+    return signatures
+
+def delta_copy(src, dst, block_size=64*1024):
+    '''
+    Update file dst to match file src by rewriting, in place, only the
+    blocks whose checksums differ (see block_signatures), then truncating
+    dst to the size of src.  The strong checksum is only computed for
+    blocks whose weak checksum matches.  Return number of bytes written.
+    ex: delta_copy('C:/vm/disk.vhd', 'E:/backup/disk.vhd')
+    '''
+    if not os.path.isfile(dst):
+        return _copy_file((src, dst))
+    signatures = block_signatures(dst, block_size)
+    written = 0
+    with open(src, 'rb') as fsrc:
+        with open(dst, 'r+b') as fdst:
+            index = 0
+            block = fsrc.read(block_size)
+            while block:
+                same = False
+                if index < len(signatures):
+                    weak, strong = signatures[index]
+                    same = (zlib.adler32(block) == weak and
+                            hashlib.md5(block).digest() == strong)
+                if not same:
+                    fdst.seek(index*block_size)
+                    fdst.write(block)
+                    written += len(block)
+                index += 1
+                block = fsrc.read(block_size)
+            fdst.truncate(fsrc.tell())
+    shutil.copystat(src, dst)
+    return written
+
+def _delta_copy_file(args):
+    src, dst = args
+    return delta_copy(src, dst)
+
+def _older(dst_mtime, src_mtime):
+    '''
+    Compare modification times in whole seconds, since copied timestamps can
+    lose sub-second precision on the way.
+    >>> _older(10.2, 10.9)
+    False
+    >>> _older(9.9, 10.0)
+    True
+    '''
+    return int(dst_mtime) < int(src_mtime)
+
+def sync_plan(src, dst, overwrite_older=True, skip=()):
+    '''
+    Compare directory src with dst and return (dirs, files), where dirs are
+    the directories to create in dst and files is a list of
+    (source, destination, size) for files missing from dst, or newer in
+    src if overwrite_older is True.  Each directory of src and dst is
+    listed once with scandir; nothing is changed.  Directories in skip,
+    given relative to src (such as compare_trees(src, dst)['same']) or as
+    absolute paths, are not descended into.
+    '''
+    skip = set(os.path.normpath(os.path.join(src, x)) for x in skip)
+    dirs = []
+    files = []
+    if os.path.normpath(src) in skip:
+        return dirs, files
+    stack = [(src, dst, os.path.isdir(dst))]
+    while stack:
+        source, destination, exists = stack.pop()
+        existing = {}
+        if exists:
+            for entry in scandir(destination):
+                existing[entry.name] = entry
+        else:
+            dirs.append(destination)
+        for entry in scandir(source):
+            target = os.path.join(destination, entry.name)
+            other = existing.get(entry.name)
+            if entry.is_dir():
+                if os.path.normpath(entry.path) in skip:
+                    continue
+                isdir = other is not None and other.is_dir()
+                stack.append((entry.path, target, isdir))
+            elif entry.is_file():
+                st = entry.stat()
+                if other is None or (overwrite_older and
+                                     _older(other.stat().st_mtime, st.st_mtime)):
+                    files.append((entry.path, target, st.st_size))
+    return dirs, files
+
+def sync(src, dst, overwrite_older=True, workers=4, delta=False, skip=()):
+    '''
+    Make directory dst a copy of directory src (see sync_plan) and return
+    dictionary {'dirs': created, 'files': copied, 'bytes': written}.
+    Files are copied by a pool of threads and keep their modification
+    times, so files copied once are skipped by later syncs.  With
+    delta=True, older files in dst are updated with delta_copy.
+    '''
+    dirs, files = sync_plan(src, dst, overwrite_older, skip)
+    for directory in dirs:
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+    report = {'dirs': len(dirs), 'files': 0, 'bytes': 0}
+    pool = ThreadPool(workers)
+    try:
+        items = [(source, target) for source, target, size in files]
+        copy_file = _delta_copy_file if delta else _copy_file
+        for n in pool.imap_unordered(copy_file, items):
+            report['files'] += 1
+            report['bytes'] += n
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+    return report
+
+def copy(src, dst, overwrite_older=True, workers=4, delta=False, skip=()):
     '''
     Copy src (file or dir) to dst (dir). If src exists in dst, it will only
     be copied if it is newer unless overwrite_older=False.
+    Directories are copied with sync, leaving out the directories of src
+    in skip (see sync_plan).  With delta=True, newer files only have their
+    changed blocks rewritten (see delta_copy).
     '''
     if os.path.isdir(src):
-        if not os.path.exists(dst):
-            os.makedirs(dst)
-        src_base = os.path.basename(src)
-        destination = os.path.join(dst, src_base)
-        if os.path.exists(destination):
-            for i in os.listdir(src):
-                copy(os.path.join(src, i), os.path.join(dst, src_base))
-        else:
-            shutil.copytree(src,destination)
+        destination = os.path.join(dst, os.path.basename(src))
+        return sync(src, destination, overwrite_older, workers, delta, skip)
     if os.path.isfile(src):
         destination = os.path.join(dst, os.path.basename(src))
         if os.path.exists(destination):
             time_modified_dst = os.path.getmtime(destination)
             time_modified_src = os.path.getmtime(src)           
-            if time_modified_dst < time_modified_src and overwrite_older:
-                os.remove(destination)
-                shutil.copy(src, destination)
+            if _older(time_modified_dst, time_modified_src) and overwrite_older:
+                if delta:
+                    delta_copy(src, destination)
+                else:
+                    _copy_file((src, destination))
             else:
                 pass
         else:
             if not os.path.exists(dst):
                 os.makedirs(dst)
-            shutil.copy(src, destination)
+            _copy_file((src, destination))
 
-def copy_contents(src, dst):
-    '''Copy the contents of directory, src, into the directory, dst.'''
+def copy_contents(src, dst, workers=4, skip=()):
+    '''
+    Copy the contents of directory, src, into the directory, dst.
+    Directories of src in skip are left out (see sync_plan), e.g.
+    copy_contents(src, dst, skip=compare_trees(src, dst)['same']).
+    '''
     if os.path.exists(src):
-        if not os.path.exists(dst):
-            os.makedirs(dst)
         if os.path.isdir(src):
-            for i in os.listdir(src):
-                if not os.path.exists(dst):
-                    os.makedirs(dst)
-                copy(os.path.join(src, i), dst)
+            return sync(src, dst, workers=workers, skip=skip)
         else:
             warn('Cannot use copy_contents on file.')
             pass
     else:
         warn(src + ' does not exist.')
     
+class Checkpoint(object):
+    '''
+    Progress of a long running scan, pickled to path so that an
+    interrupted scan can be resumed.  Scans keep their progress in the
+    state dictionary and call tick(), which saves it at most once every
+    interval seconds.  Callables in hooks are called before each save, so
+    scans can put progress that is costly to copy into state only when it
+    is written.  The state is written to a temporary file first, so a
+    crash while saving does not leave a truncated checkpoint behind.
+    Large data that does not change once computed (such as the listing of
+    a finished walk) can be written once to a file of its own with store.
+
+    ex:
+        >> checkpoint = Checkpoint('C:/temp/find.ckpt')
+        >> find('python.exe', 'C:\\', find_all=True, checkpoint=checkpoint)
+        (interrupt with Ctrl+C, then run the same line again to resume)
+    '''
+    def __init__(self, path, interval=60):
+        self.path = path
+        self.interval = interval
+        self.state = {}
+        self.hooks = {}
+        self.saved = time.time()
+        if os.path.exists(path):
+            self.state = self._read(path)
+
+    def __repr__(self):
+        return 'Checkpoint(%r)'%self.path
+
+    def _read(self, pathName):
+        with open(pathName, 'rb') as f:
+            return pickle.loads(f.read())
+
+    def _write(self, pathName, data):
+        temp = pathName + '.tmp'
+        with open(temp, 'wb') as f:
+            f.write(pickle.dumps(data, 2))
+        if os.path.exists(pathName):
+            os.remove(pathName)
+        os.rename(temp, pathName)
+
+    def save(self):
+        '''Call hooks, then write state to path.'''
+        for hook in list(self.hooks.values()):
+            hook()
+        self._write(self.path, self.state)
+        self.saved = time.time()
+
+    def store(self, name, data):
+        '''Write data to its own file next to path, see restore.'''
+        self._write('%s.%s'%(self.path, name), data)
+        stored = self.state.setdefault('stored', [])
+        if name not in stored:
+            stored.append(name)
+
+    def restore(self, name):
+        '''Return data written by store, or None.'''
+        pathName = '%s.%s'%(self.path, name)
+        if name in self.state.get('stored', []) and os.path.exists(pathName):
+            return self._read(pathName)
+        return None
+
+    def tick(self):
+        '''Save state if it was last saved more than interval seconds ago.'''
+        if time.time() - self.saved >= self.interval:
+            self.save()
+
+    def clear(self):
+        '''Forget state and delete the checkpoint files.'''
+        names = ['%s.%s'%(self.path, x) for x in self.state.get('stored', [])]
+        self.state = {}
+        self.hooks = {}
+        for pathName in [self.path] + names:
+            if os.path.exists(pathName):
+                os.remove(pathName)
+
+def _scan_dir(dirpath, match, follow_symlinks=False, ignore_errors=True):
+    '''
+    Return (matches, subdirectories, error) for a single directory, where
+    matches are the paths of entries for which match(entry) is True.
+    Directories that cannot be listed are skipped, like os.path.walk does,
+    unless ignore_errors is False.
+    '''
+    matches = []
+    subdirs = []
+    try:
+        for entry in scandir(dirpath):
+            if match(entry):
+                matches.append(entry.path)
+            if entry.is_dir(follow_symlinks=follow_symlinks):
+                subdirs.append(entry.path)
+    except OSError as error:
+        if not ignore_errors:
+            return matches, subdirs, error
+    except Exception as error:
+        return matches, subdirs, error
+    return matches, subdirs, None
+
+def search(match, searchDir, workers=4, checkpoint=None,
+           follow_symlinks=False, ignore_errors=True):
+    '''
+    Yield paths of entries in searchDir and its subdirectories for which
+    match(entry) is True, where entry is an os.DirEntry.
+
+    Directories are listed concurrently by a pool of threads and matches
+    are yielded as soon as their directory has been listed, so the search
+    stops as soon as the caller stops iterating (or closes the generator).
+    Shallower directories are generally listed first.
+
+    If checkpoint is a Checkpoint, the directories still to be listed and
+    the matches found so far are saved in it, and a search started with
+    a saved checkpoint yields the saved matches and lists only the
+    directories that were left.
+
+    Symbolic links to directories are only followed if follow_symlinks is
+    True, and directories that cannot be listed are skipped unless
+    ignore_errors is False, in which case the error is raised.
+    '''
+    results = Queue()
+    pool = ThreadPool(workers)
+    def submit(dirpath):
+        callback = lambda result: results.put((dirpath, result))
+        pool.apply_async(_scan_dir, (dirpath, match, follow_symlinks,
+                                     ignore_errors), callback=callback)
+    state = {'pending': [searchDir], 'matches': []}
+    if checkpoint is not None:
+        state = checkpoint.state.setdefault('search', state)
+    pending = set(state['pending'])
+    def save_pending():
+        state['pending'] = list(pending)
+    if checkpoint is not None:
+        checkpoint.hooks['search'] = save_pending
+    try:
+        for pathName in list(state['matches']):
+            yield pathName
+        for dirpath in pending:
+            submit(dirpath)
+        while pending:
+            dirpath, (matches, subdirs, error) = results.get()
+            if error:
+                raise error
+            pending.discard(dirpath)
+            for subdir in subdirs:
+                submit(subdir)
+                pending.add(subdir)
+            if checkpoint is not None:
+                state['matches'].extend(matches)
+                checkpoint.tick()
+            for pathName in matches:
+                yield pathName
+    except KeyboardInterrupt:
+        if checkpoint is not None:
+            checkpoint.save()
+        raise
+    finally:
+        if checkpoint is not None:
+            save_pending()
+            checkpoint.hooks.pop('search', None)
+        pool.terminate()
+        pool.join()
+
+def _dir_usage(dirpath, cached=None):
+    '''
+    Return (dirpath, (mtime, bytes, files, subdirectories), error) for the
+    files directly in dirpath.  cached is returned instead if its mtime is
+    the current mtime of dirpath.
+    '''
+    try:
+        mtime = os.stat(dirpath).st_mtime
+        if cached and cached[0] == mtime:
+            return dirpath, cached, None
+        size = files = 0
+        subdirs = []
+        for entry in scandir(dirpath):
+            if entry.is_dir(follow_symlinks=False):
+                subdirs.append(entry.path)
+            elif entry.is_file(follow_symlinks=False):
+                size += entry.stat(follow_symlinks=False).st_size
+                files += 1
+    except OSError:
+        return dirpath, (None, 0, 0, []), None
+    except Exception as error:
+        return dirpath, None, error
+    return dirpath, (mtime, size, files, subdirs), None
+
+def disk_usage(dirpath, top=10, workers=4, cache_path=None):
+    '''
+    Return list of (path, bytes, files) for the top heaviest directories
+    below dirpath, largest first, where bytes and files are totals for the
+    whole subtree.  Directories are listed concurrently by a pool of threads.
+
+    If cache_path is given, the totals of each directory (without its
+    subdirectories) are pickled there, keyed by directory mtime, and a
+    directory whose mtime has not changed is not listed again.  Note that
+    growing a file in place does not change the mtime of its directory.
+    ex: disk_usage('C:\\Users', top=5, cache_path='C:/temp/usage.pkl')
+    '''
+    cache = {}
+    if cache_path and os.path.exists(cache_path):
+        with open(cache_path, 'rb') as f:
+            cache = pickle.loads(f.read())
+    records = {}
+    results = Queue()
+    pool = ThreadPool(workers)
+    def submit(subdir):
+        pool.apply_async(_dir_usage, (subdir, cache.get(subdir)),
+                         callback=results.put)
+    try:
+        submit(dirpath)
+        pending = 1
+        while pending:
+            subdir, record, error = results.get()
+            pending -= 1
+            if error:
+                raise error
+            records[subdir] = record
+            for i in record[3]:
+                submit(i)
+                pending += 1
+    finally:
+        pool.terminate()
+        pool.join()
+    totals = dict((k, [v[1], v[2]]) for k, v in records.items())
+    #children always have longer paths than their parents
+    for subdir in sorted(totals, key=len, reverse=True):
+        parent = os.path.dirname(subdir)
+        if subdir != dirpath and parent in totals:
+            totals[parent][0] += totals[subdir][0]
+            totals[parent][1] += totals[subdir][1]
+    if cache_path:
+        for k in [x for x in cache if _within(x, dirpath)]:
+            del cache[k]
+        cache.update(records)
+        with open(cache_path, 'wb') as f:
+            f.write(pickle.dumps(cache, 2))
+    usage = [(k, v[0], v[1]) for k, v in totals.items() if k != dirpath]
+    usage.sort(key=lambda x: x[1], reverse=True)
+    return usage[:top]
+
+def _default_search_dir():
+    return os.path.splitdrive(os.getcwd())[0] + '\\'
+
+def _within(pathName, dirpath):
+    '''Return True if pathName is dirpath or is inside it.'''
+    return pathName == dirpath or pathName.startswith(os.path.join(dirpath, ''))
+
+def iter_find_dir(dirname, searchDir='', workers=4, index=None,
+                  checkpoint=None):
+    '''
+    Yield directories named "dirname" (case-insensitive) in searchDir,
+    excluding directories nested in another directory of the same name.
+    If index is a FileIndex, it is queried instead of walking searchDir.
+    checkpoint is passed to search.
+    '''
+    name = dirname.upper()
+    def is_match(directory):
+        count = 0
+        for i in os.path.split(directory.upper()):
+            count += i.count(name)
+        return count == 1 #Excludes "arg/arg/", etc...
+    def match(entry):
+        return (entry.name.upper() == name and
+                entry.is_dir(follow_symlinks=False) and is_match(entry.path))
+    if index is not None:
+        searchDir = searchDir or index.root
+    searchDir = searchDir or _default_search_dir()
+    if os.path.basename(searchDir).upper() == name and is_match(searchDir):
+        yield searchDir
+    if index is not None:
+        found = (x for x in index.query(dirname, dirs=True)
+                 if _within(x, searchDir) and is_match(x))
+    else:
+        found = search(match, searchDir, workers, checkpoint)
+    for i in found:
+        yield i
+
+def iter_find(filename, searchDir='', workers=4, index=None,
+              checkpoint=None):
+    '''
+    Yield paths of entries named "filename" in searchDir.
+    If index is a FileIndex, it is queried instead of walking searchDir.
+    checkpoint is passed to search.
+    '''
+    if index is not None:
+        searchDir = searchDir or index.root
+        for i in index.query(filename, ignore_case=False):
+            if _within(i, searchDir):
+                yield i
+        return
+    match = lambda entry: entry.name == filename
+    searchDir = searchDir or _default_search_dir()
+    for i in search(match, searchDir, workers, checkpoint):
+        yield i
+
 @Profiled
-def find_dir(dirname, searchDir='', find_all=False):
-    '''Returns highest level directory named "dirname"'''
-    def filterDirs(dirname, directory, files):
-        if os.path.basename(directory).upper() == dirname.upper():
-            count = 0
-            for i in os.path.split(directory.upper()): 
-                count += i.count(dirname.upper())
-            if count == 1: #Excludes "arg/arg/", etc...
-                dirs.append(directory)        
-    dirs = []
-    startDir = os.getcwd()
+def find_dir(dirname, searchDir='', find_all=False, workers=4, index=None,
+             checkpoint=None):
+    '''
+    Returns highest level directory named "dirname"
+    If index is a FileIndex, it is queried instead of walking searchDir.
+    If checkpoint is a Checkpoint, an interrupted search resumes from it;
+    it is cleared once the search returns.
+    '''
+    if index is not None:
+        searchDir = searchDir or index.root
     if not searchDir:
-        searchDir = os.path.splitdrive(startDir)[0]  + '\\'
+        searchDir = _default_search_dir()
         print("Searching for \"%s\" in %s..."%(dirname, searchDir))
         print("This may take several minutes...")
     else:
         print("Searching for \"%s\" in %s..."%(dirname, searchDir))
-    os.chdir(searchDir)
-    os.path.walk(searchDir, filterDirs, dirname)
+    found = iter_find_dir(dirname, searchDir, workers, index, checkpoint)
+    dirs = list(found) if find_all else list(islice(found, 1))
+    found.close()
+    if checkpoint is not None:
+        checkpoint.clear()
     if not dirs:
         dirs.append(dirname + ' Not Found in ' + searchDir)
-    os.chdir(startDir)
-    return dirs if find_all else dirs[0] 
+    return dirs if find_all else dirs[0]
 
 @Profiled
-def find(filename, searchDir='', find_all=False):
-    def filterFiles(filename, directory, files):
-        if filename in files:
-            foundFiles.append(directory + '\\' + files[files.index(filename)])
-    foundFiles = []
-    startDir = os.getcwd()
+def find(filename, searchDir='', find_all=False, workers=4, index=None,
+         checkpoint=None):
+    '''
+    Returns first path of a file named "filename" in searchDir.
+    If index is a FileIndex, it is queried instead of walking searchDir.
+    If checkpoint is a Checkpoint, an interrupted search resumes from it;
+    it is cleared once the search returns.
+    '''
+    if index is not None:
+        searchDir = searchDir or index.root
     if not searchDir:
-        searchDir = os.path.splitdrive(startDir)[0] + '\\'
+        searchDir = _default_search_dir()
         print("Searching for \"%s\" in %s..."%(filename, searchDir))
         print("This may take several minutes...")
     else:
         pass
-    os.path.walk(searchDir, filterFiles, filename)
+    found = iter_find(filename, searchDir, workers, index, checkpoint)
+    foundFiles = list(found) if find_all else list(islice(found, 1))
+    found.close()
+    if checkpoint is not None:
+        checkpoint.clear()
     if not foundFiles:
         foundFiles.append(filename + ' Not Found in ' + searchDir)
     return foundFiles if find_all else foundFiles[0]
 
+def _grep_file(args):
+    '''
+    Return (hits, error) where hits is the list of (path, line number,
+    line) for lines of a file that match pattern.  Files with a NUL byte in
+    their first 8000 bytes are treated as binary and skipped.
+    Like grep, ^ and $ match at the start and end of each line, and
+    matches do not span lines.
+
+    >>> import tempfile
+    >>> fd, name = tempfile.mkstemp()
+    >>> os.write(fd, b'first\\nhello there\\n')
+    18
+    >>> os.close(fd)
+    >>> [x[1:] for x in _grep_file((name, '^hello', 0))[0]]
+    [(2, 'hello there')]
+    >>> [x[1:] for x in _grep_file((name, 'there$', 0))[0]]
+    [(2, 'hello there')]
+    >>> _grep_file((name, 'first\\s+hello', 0))[0]
+    []
+    >>> os.remove(name)
+    '''
+    pathName, pattern, flags = args
+    hits = []
+    try:
+        regex = re.compile(pattern, flags | re.MULTILINE)
+        with open(pathName, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            if not size or b'\0' in f.read(8000):
+                return hits, None
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                pos = 0
+                line_no = 1
+                counted = 0
+                while pos < size:
+                    m = regex.search(data, pos)
+                    if not m:
+                        break
+                    start = data.rfind(b'\n', 0, m.start()) + 1
+                    if start >= size:
+                        break
+                    end = data.find(b'\n', m.start())
+                    end = size if end < 0 else end
+                    if m.end() > end:
+                        #the match spans lines, look for one in this line only
+                        m = regex.search(data, max(pos, start), end)
+                    if m:
+                        line_no += data[counted:start].count(b'\n')
+                        counted = start
+                        line = data[start:end].rstrip(b'\r')
+                        hits.append((pathName, line_no, line))
+                    pos = end + 1
+            finally:
+                data.close()
+    except (IOError, OSError, ValueError):
+        pass
+    except Exception as error:
+        return hits, error
+    return hits, None
+
+def grep(pattern, searchDir='', include='*', flags=0, fixed=False,
+         workers=None):
+    '''
+    Yield (path, line number, line) for every line matching the regular
+    expression pattern in files under searchDir whose name matches include
+    (fnmatch wildcards).  If fixed is True, pattern is a literal string.
+
+    Files come from lib.search and are memory-mapped and searched by a pool
+    of processes (workers=None uses one per CPU); hits are yielded as each
+    file finishes, so results arrive in no particular order.
+
+    ex:
+        >> for pathName, line_no, line in grep('TODO', 'C:\\src', '*.py'):
+        >>     print('%s:%s: %s'%(pathName, line_no, line))
+    '''
+    if fixed:
+        pattern = re.escape(pattern)
+    def match(entry):
+        return entry.is_file() and fnmatch.fnmatch(entry.name, include)
+    paths = search(match, searchDir or _default_search_dir())
+    results = Queue()
+    pool = Pool(workers)
+    limit = 4 * (workers or cpu_count())
+    def collect():
+        hits, error = results.get()
+        if error:
+            raise error
+        return hits
+    try:
+        pending = 0
+        for pathName in paths:
+            pool.apply_async(_grep_file, ((pathName, pattern, flags),),
+                             callback=results.put)
+            pending += 1
+            while pending and (pending >= limit or not results.empty()):
+                pending -= 1
+                for hit in collect():
+                    yield hit
+        while pending:
+            pending -= 1
+            for hit in collect():
+                yield hit
+    finally:
+        paths.close()
+        pool.terminate()
+        pool.join()
+
+def find_many(names, searchDir='', find_all=False, workers=4, index=None):
+    '''
+    Return dictionary of name: list of paths of entries called name in
+    searchDir, for each name in names.  Names may use fnmatch wildcards.
+
+    searchDir is walked only once, matching every entry against a set of
+    the names (and one regular expression combining the wildcard names).
+    Unless find_all is True, each list holds at most one path and the walk
+    stops as soon as every name has been found.
+    If index is a FileIndex, it is queried instead of walking searchDir.
+    '''
+    found = dict((x, []) for x in names)
+    limit = None if find_all else 1
+    if index is not None:
+        for name in found:
+            matches = iter_find(name, searchDir, index=index)
+            found[name] = list(islice(matches, limit))
+        return found
+    exact = set(x for x in found if not re.search('[*?[]', x))
+    patterns = [x for x in found if x not in exact]
+    regex = None
+    if patterns:
+        regex = re.compile('|'.join('(?:%s)'%fnmatch.translate(x)
+                                    for x in patterns))
+    def match(entry):
+        return entry.name in exact or bool(regex and regex.match(entry.name))
+    remaining = set(found)
+    results = search(match, searchDir or _default_search_dir(), workers)
+    try:
+        for pathName in results:
+            name = os.path.basename(pathName)
+            matched = [name] if name in exact else []
+            matched += [x for x in patterns if fnmatch.fnmatchcase(name, x)]
+            for x in matched:
+                if find_all or x in remaining:
+                    found[x].append(pathName)
+                    remaining.discard(x)
+            if not (find_all or remaining):
+                break
+    finally:
+        results.close()
+    return found
+
+class FileIndex(object):
+    '''
+    Filename database for a directory tree, similar to locate/updatedb.
+
+    Every file and directory name is stored once, with the id of its
+    parent directory, in a list sorted by lowercase name.  Lookups use a
+    binary search on that list, so they take milliseconds instead of a
+    walk of the whole drive.  On disk, the sorted names are front coded
+    (each name only stores what differs from the previous one) and gzipped.
+
+    refresh() only lists directories whose modification time changed.
+    Note that a directory's mtime changes when entries are added, removed
+    or renamed in it, which is all the index records.
+
+    ex:
+        >> index = FileIndex('C:\\').build().save()
+        >> index = FileIndex.load('C:\\').refresh()
+        >> index.query('*.py')
+        >> find('python.exe', index=index)
+    '''
+    def __init__(self, root, index_path=''):
+        if not index_path:
+            name = re.sub('[^\w]', '_', root) + '.idx'
+            index_path = os.path.join(os.path.dirname(__file__), name)
+        self.root = root
+        self.index_path = index_path
+        self.dirs = []
+        self.children = {}
+        self.keys = []
+        self.entries = []
+
+    def __repr__(self):
+        return 'FileIndex(%r, %s entries)'%(self.root, len(self.entries))
+
+    def __len__(self):
+        return len(self.entries)
+
+    def _list(self, dir_id):
+        '''List directory dir_id and record its entries and mtime.'''
+        dirpath = self.path(dir_id)
+        known = dict((self.dirs[i][1], i) for i, is_dir in
+                     self.children.get(dir_id, []) if is_dir)
+        children = []
+        try:
+            self.dirs[dir_id][2] = os.stat(dirpath).st_mtime
+            for entry in scandir(dirpath):
+                if entry.is_dir(follow_symlinks=False):
+                    child = known.pop(entry.name, None)
+                    if child is None:
+                        child = len(self.dirs)
+                        self.dirs.append([dir_id, entry.name, None])
+                    children.append((child, True))
+                else:
+                    children.append((entry.name, False))
+        except OSError:
+            pass
+        for child in known.values():
+            self.dirs[child] = None
+        self.children[dir_id] = children
+
+    def build(self):
+        '''Index every file and directory below self.root.'''
+        self.dirs = [[-1, self.root, None]]
+        self.children = {}
+        return self.refresh()
+
+    def refresh(self):
+        '''
+        List directories that are new or whose mtime changed since the last
+        build or refresh, and drop directories that no longer exist.
+        '''
+        i = 0
+        while i < len(self.dirs):
+            info = self.dirs[i]
+            if info and info[0] >= 0 and self.dirs[info[0]] is None:
+                self.dirs[i] = info = None
+            if info is None:
+                self.children.pop(i, None)
+            else:
+                try:
+                    mtime = os.stat(self.path(i)).st_mtime
+                except OSError:
+                    mtime = None
+                if mtime is None and info[0] >= 0:
+                    self.dirs[i] = None
+                    self.children.pop(i, None)
+                elif mtime != info[2] or i not in self.children:
+                    self._list(i)
+            i += 1
+        self._sort()
+        return self
+
+    def _sort(self):
+        items = []
+        for dir_id, children in self.children.items():
+            for child, is_dir in children:
+                if is_dir and self.dirs[child] is None:
+                    continue
+                name = self.dirs[child][1] if is_dir else child
+                items.append((name.lower(), name, dir_id, is_dir))
+        items.sort()
+        self.keys = [x[0] for x in items]
+        self.entries = [x[1:] for x in items]
+
+    def path(self, dir_id):
+        '''Return absolute path of directory dir_id.'''
+        names = []
+        while dir_id >= 0:
+            parent, name = self.dirs[dir_id][:2]
+            names.append(name)
+            dir_id = parent
+        return os.path.join(*reversed(names))
+
+    def save(self):
+        '''Write front coded index to self.index_path.'''
+        coded = []
+        previous = ''
+        for name, parent, is_dir in self.entries:
+            shared = len(os.path.commonprefix([previous, name]))
+            coded.append((shared, name[shared:], parent, is_dir))
+            previous = name
+        data = pickle.dumps({'root': self.root, 'dirs': self.dirs,
+                             'entries': coded}, 2)
+        f = gzip.open(self.index_path, 'wb')
+        try:
+            f.write(data)
+        finally:
+            f.close()
+        return self
+
+    @classmethod
+    def load(cls, root, index_path=''):
+        '''Load the index of root saved by FileIndex.save.'''
+        index = cls(root, index_path)
+        f = gzip.open(index.index_path, 'rb')
+        try:
+            data = pickle.loads(f.read())
+        finally:
+            f.close()
+        index.dirs = data['dirs']
+        name = ''
+        for shared, suffix, parent, is_dir in data['entries']:
+            name = name[:shared] + suffix
+            index.keys.append(name.lower())
+            index.entries.append((name, parent, is_dir))
+            if not is_dir:
+                index.children.setdefault(parent, []).append((name, False))
+        for i, info in enumerate(index.dirs):
+            if info and info[2] is not None:
+                index.children.setdefault(i, [])
+            if info and info[0] >= 0:
+                index.children.setdefault(info[0], []).append((i, True))
+        return index
+
+    def query(self, pattern, dirs=None, ignore_case=True):
+        '''
+        Yield paths of entries whose name matches pattern, which may use
+        fnmatch wildcards (*, ?, [seq]).  dirs=True only yields
+        directories, dirs=False only files.
+        '''
+        wildcard = re.search('[*?[]', pattern)
+        prefix = pattern[:wildcard.start()] if wildcard else pattern
+        prefix = prefix.lower()
+        flags = re.IGNORECASE if ignore_case else 0
+        regex = re.compile(fnmatch.translate(pattern), flags)
+        i = bisect.bisect_left(self.keys, prefix)
+        paths = {}
+        while i < len(self.keys) and self.keys[i].startswith(prefix):
+            if not wildcard and self.keys[i] != prefix:
+                break
+            name, parent, is_dir = self.entries[i]
+            if regex.match(name) and dirs in (None, is_dir):
+                if parent not in paths:
+                    paths[parent] = self.path(parent)
+                yield os.path.join(paths[parent], name)
+            i += 1
+
 def mklink(real, link):
     successStatus = ''
     arg = '/H' #Default set to hard link
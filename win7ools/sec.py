@@ -1,17 +1,23 @@
 # -*- coding: utf-8 -*-
 """secure.py -- AES Encryption and other security related functions"""
 
+import binascii
 import codecs
 from ctypes import windll, cdll, c_buffer, byref, POINTER, Structure, c_char
 from ctypes.wintypes import DWORD
 import hashlib
 import hmac
+import math
+import mmap
 import os.path as path
 import string
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
 from Crypto.Cipher import AES
 from Crypto import Random
 
 BLOCK_SIZE = 256*128
+LEAF_SIZE = 1024*1024
 
 #passwords_2011 lists the most common passwords from 2011 as listed on the
 #forum of LearnHacking.in
@@ -57,17 +63,7 @@ def md5(hashpath, key='', block_size=BLOCK_SIZE):
     >>> md5('hello world', 'key')
     'ae92cf51adf91130130aefc2b39a7595'
     '''
-    if key:
-        MD5 = hmac.new(str(key), digestmod=hashlib.md5)
-    else:
-        MD5 = hashlib.md5()
-    if path.exists(hashpath):
-        with open(hashpath,'rb') as f: 
-            for chunk in iter(lambda: f.read(block_size), b''): 
-                 MD5.update(chunk)
-    else:
-        MD5.update(hashpath)
-    return MD5.hexdigest()
+    return digests(hashpath, ['md5'], key, block_size)['md5']
     
 def sha1(hashpath, key='', block_size=BLOCK_SIZE):
     '''
@@ -86,17 +82,7 @@ def sha1(hashpath, key='', block_size=BLOCK_SIZE):
     >>> sha1('hello world', 'key')
     '34dd234b92683593560528f6193ea68c8005f615'
     '''
-    if key:
-        SHA1 = hmac.new(str(key), digestmod=hashlib.sha1)
-    else:
-        SHA1 = hashlib.sha1()
-    if path.exists(hashpath):
-        with open(hashpath,'rb') as f: 
-            for chunk in iter(lambda: f.read(block_size), b''): 
-                 SHA1.update(chunk)
-    else:
-        SHA1.update(hashpath)
-    return SHA1.hexdigest()
+    return digests(hashpath, ['sha1'], key, block_size)['sha1']
 
 def sha256(hashpath, key='', block_size=BLOCK_SIZE):
     '''
@@ -112,17 +98,7 @@ def sha256(hashpath, key='', block_size=BLOCK_SIZE):
     >>> sha256('hello world', 'key')
     '0ba06f1f9a6300461e43454535dc3c4223e47b1d357073d7536eae90ec095be1'
     '''
-    if key:
-        SHA = hmac.new(str(key), digestmod=hashlib.sha256)
-    else:
-        SHA = hashlib.sha256()
-    if path.exists(hashpath):
-        with open(hashpath,'rb') as f: 
-            for chunk in iter(lambda: f.read(block_size), b''): 
-                 SHA.update(chunk)
-    else:
-        SHA.update(hashpath)
-    return SHA.hexdigest()
+    return digests(hashpath, ['sha256'], key, block_size)['sha256']
 
 def sha512(hashpath, key='', block_size=BLOCK_SIZE):
     '''
@@ -138,17 +114,410 @@ def sha512(hashpath, key='', block_size=BLOCK_SIZE):
     >>> sha512('hello world', 'key')
     'ea0625a5ff1cd1653a327f8a4ae2f478fc51405c73ddac3a8a05a7a810310a6a14d7c8b4d284013493a6016ecadc772cfd98ed6cbe745949c5e6119fafb63b54'
     '''
-    if key:
-        SHA = hmac.new(str(key), digestmod=hashlib.sha512)
+    return digests(hashpath, ['sha512'], key, block_size)['sha512']
+
+def read_chunks(source, block_size=BLOCK_SIZE):
+    '''
+    Yield chunks of at most block_size bytes from source, which can be:
+        - a readable object with readinto (files, pipes, io streams)
+        - a socket (recv_into is used)
+        - any other object with read
+        - a buffer (str, bytearray, memoryview, mmap)
+    Readable objects are read into one preallocated buffer, and buffers
+    are sliced with memoryview (or buffer, for objects such as mmap that
+    only support the old buffer interface of Python 2), so no new string
+    is created per chunk.  Objects with read are only read with it if
+    they are not buffers.  Each chunk is only valid until the next one
+    is requested.
+
+    >>> [x.tobytes() for x in read_chunks('hello world', 4)]
+    ['hell', 'o wo', 'rld']
+    '''
+    if hasattr(source, 'readinto') or hasattr(source, 'recv_into'):
+        readinto = getattr(source, 'readinto', None) or source.recv_into
+        view = memoryview(bytearray(block_size))
+        n = readinto(view)
+        while n:
+            yield view[:n]
+            n = readinto(view)
+        return
+    try:
+        data = memoryview(source)
+    except TypeError:
+        data = None
+    if data is not None:
+        for i in range(0, len(data), block_size):
+            yield data[i:i + block_size]
+        return
+    try:
+        #Python 2 only: buffer(source, offset, size) does not copy
+        for i in range(0, len(source), block_size):
+            yield buffer(source, i, block_size)
+        return
+    except (NameError, TypeError):
+        pass
+    if hasattr(source, 'read'):
+        for chunk in iter(lambda: source.read(block_size), b''):
+            yield chunk
     else:
-        SHA = hashlib.sha512()
-    if path.exists(hashpath):
-        with open(hashpath,'rb') as f: 
-            for chunk in iter(lambda: f.read(block_size), b''): 
-                 SHA.update(chunk)
+        for i in range(0, len(source), block_size):
+            yield source[i:i + block_size]
+
+def _is_path(hashpath):
+    '''Return True if hashpath is a string naming an existing path.'''
+    try:
+        return isinstance(hashpath, (str, type(u''))) and path.exists(hashpath)
+    except (TypeError, ValueError):
+        return False
+
+def _update(hashes, chunks):
+    for chunk in chunks:
+        for HASH in hashes:
+            HASH.update(chunk)
+
+def digests(hashpath, algorithms=('md5', 'sha256'), key='',
+            block_size=BLOCK_SIZE, use_mmap=False):
+    '''
+    Return dictionary of algorithm: hexadecimal digest for each hashlib
+    algorithm name in algorithms.  hashpath is the path to a file, a
+    string, or anything read_chunks accepts (open files, sockets,
+    memoryviews...).  The data is read only once and every chunk is fed
+    to all of the hash objects.
+
+    If use_mmap is True, files given by path are memory-mapped instead of
+    being read into a buffer.
+
+    If key is designated, HMAC will be utilized with each algorithm.
+
+    >>> digests('hello world', ['md5', 'sha1']) == {
+    ...     'md5': md5('hello world'), 'sha1': sha1('hello world')}
+    True
+
+    >>> digests('hello world', ['md5'], 'key')
+    {'md5': 'ae92cf51adf91130130aefc2b39a7595'}
+
+    >>> digests(memoryview(bytearray('hello world')), ['md5'])
+    {'md5': '5eb63bbbe01eeed093cb22bb8f5acdc3'}
+    '''
+    hashes = {}
+    for name in algorithms:
+        constructor = lambda data='', name=name: hashlib.new(name, data)
+        if key:
+            hashes[name] = hmac.new(str(key), digestmod=constructor)
+        else:
+            hashes[name] = constructor()
+    if _is_path(hashpath):
+        with open(hashpath, 'rb') as f:
+            if use_mmap and path.getsize(hashpath):
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                try:
+                    _update(hashes.values(), read_chunks(data, block_size))
+                finally:
+                    data.close()
+            else:
+                _update(hashes.values(), read_chunks(f, block_size))
+    else:
+        _update(hashes.values(), read_chunks(hashpath, block_size))
+    return {name: HASH.hexdigest() for name, HASH in hashes.items()}
+
+#GEAR maps each byte to a pseudo-random 32-bit integer for content-defined
+#chunking (see chunks)
+GEAR = [int(hashlib.md5(('%d'%i).encode('ascii')).hexdigest()[:8], 16)
+        for i in range(256)]
+
+def _gear_fingerprints(data):
+    '''
+    Return NumPy array of the gear hash of the 32 bytes ending at each
+    position of data, or None if NumPy is not installed.
+    '''
+    try:
+        import numpy
+    except ImportError:
+        return None
+    gear = numpy.array(GEAR, dtype=numpy.uint32)
+    fingerprints = gear[numpy.frombuffer(data, dtype=numpy.uint8)]
+    #Each pass doubles the number of bytes combined into each hash
+    for k in [1, 2, 4, 8, 16]:
+        fingerprints[k:] += fingerprints[:-k] << k
+    return fingerprints
+
+def _cut_point(data, start, end, min_size, avg_size, mask_s, mask_l,
+               fingerprints=None):
+    '''
+    Return the length of the chunk of data starting at start (FastCDC).
+    The gear hash is not checked for the first min_size bytes, a harder
+    mask is used until avg_size bytes and an easier one after that, which
+    keeps chunk sizes close to avg_size.  fingerprints, if given, are the
+    precomputed hashes from _gear_fingerprints.
+    '''
+    size = end - start
+    if size <= min_size:
+        return size
+    normal = start + min(avg_size, size)
+    i = start + min_size
+    if fingerprints is not None:
+        for (a, b, mask) in [(i, normal, mask_s), (normal, end, mask_l)]:
+            hits = (fingerprints[a:b] & mask == 0).nonzero()[0]
+            if len(hits):
+                return a + int(hits[0]) + 1 - start
+        return size
+    fp = 0
+    for j in range(i - 31, i):
+        fp = ((fp << 1) + GEAR[data[j]]) & 0xFFFFFFFF
+    while i < normal:
+        fp = ((fp << 1) + GEAR[data[i]]) & 0xFFFFFFFF
+        i += 1
+        if not fp & mask_s:
+            return i - start
+    while i < end:
+        fp = ((fp << 1) + GEAR[data[i]]) & 0xFFFFFFFF
+        i += 1
+        if not fp & mask_l:
+            return i - start
+    return size
+
+def chunks(hashpath, min_size=2048, avg_size=8192, max_size=65536,
+           algorithm='sha1'):
+    '''
+    Split hashpath (path to a file, string, or anything read_chunks
+    accepts) into content-defined chunks with FastCDC and yield
+    (offset, length, hexadecimal digest) for each chunk.
+
+    Chunk boundaries depend on the 32 bytes before them rather than on
+    offsets, so data inserted into or removed from a file only changes
+    the chunks around the edit.  min_size must be at least 32.  NumPy is
+    used to compute the rolling hash if it is installed.
+
+    >>> data = ''.join(md5(str(i)) for i in range(5000))
+    >>> sum(length for offset, length, digest in chunks(data)) == len(data)
+    True
+    >>> original = set(x[2] for x in chunks(data))
+    >>> edited = set(x[2] for x in chunks('inserted' + data))
+    >>> len(original - edited)
+    1
+    '''
+    bits = int(round(math.log(avg_size, 2)))
+    mask_s = ((1 << (bits + 1)) - 1) << (31 - bits)
+    mask_l = ((1 << (bits - 1)) - 1) << (33 - bits)
+    if _is_path(hashpath):
+        f = open(hashpath, 'rb')
+        source = f
     else:
-        SHA.update(hashpath)
-    return SHA.hexdigest()
+        f = None
+        source = hashpath
+    try:
+        blocks = read_chunks(source, max_size * 16)
+        buf = bytearray()
+        fingerprints = None
+        pos = 0
+        offset = 0
+        eof = False
+        while True:
+            if not eof and len(buf) - pos < max_size:
+                del buf[:pos]
+                pos = 0
+                while not eof and len(buf) < max_size:
+                    block = next(blocks, None)
+                    if block is None:
+                        eof = True
+                    else:
+                        buf += block
+                fingerprints = _gear_fingerprints(buf)
+            if pos >= len(buf):
+                break
+            end = min(len(buf), pos + max_size)
+            n = _cut_point(buf, pos, end, min_size, avg_size, mask_s, mask_l,
+                           fingerprints)
+            digest = hashlib.new(algorithm, buf[pos:pos + n]).hexdigest()
+            yield offset, n, digest
+            pos += n
+            offset += n
+    finally:
+        if f:
+            f.close()
+
+class MerkleTree(object):
+    '''
+    Hash tree of a file (or string): the data is split into leaf_size
+    blocks that are hashed in parallel by a pool of threads and combined
+    pairwise into a single root hash.  Leaf and node hashes are prefixed
+    with different bytes so that one cannot be passed off as the other.
+
+    The leaf hashes are kept, so after an edit update() only re-reads the
+    blocks that changed, and verify() reports which blocks differ.
+
+    >>> tree = MerkleTree('hello world', leaf_size=4)
+    >>> len(tree.leaves)
+    3
+    >>> tree.root == MerkleTree('hello world', leaf_size=4, workers=1).root
+    True
+    >>> tree.root == MerkleTree('hello word!', leaf_size=4).root
+    False
+    >>> tree.verify('hello word!')
+    [2]
+    '''
+    def __init__(self, hashpath, leaf_size=LEAF_SIZE, algorithm='sha256',
+                 workers=None):
+        self.hashpath = hashpath
+        self.leaf_size = leaf_size
+        self.algorithm = algorithm
+        self.workers = workers or cpu_count()
+        self.size = self._size()
+        self.leaves = self._hash_leaves(range(self._count()))
+        self.root = self._get_root()
+
+    def __repr__(self):
+        return 'MerkleTree(%s leaves, root=%s)'%(len(self.leaves), self.root)
+
+    def _size(self, hashpath=None):
+        hashpath = self.hashpath if hashpath is None else hashpath
+        if _is_path(hashpath):
+            return path.getsize(hashpath)
+        return len(hashpath)
+
+    def _count(self, hashpath=None):
+        return max(1, -(-self._size(hashpath) // self.leaf_size))
+
+    def _hash_range(self, args):
+        '''Return hashes of leaves in indices, read from hashpath.'''
+        hashpath, indices = args
+        hashes = []
+        f = open(hashpath, 'rb') if _is_path(hashpath) else None
+        try:
+            for i in indices:
+                start = i * self.leaf_size
+                if f:
+                    f.seek(start)
+                    data = f.read(self.leaf_size)
+                else:
+                    data = hashpath[start:start + self.leaf_size]
+                leaf = hashlib.new(self.algorithm, b'\x00')
+                leaf.update(data)
+                hashes.append(leaf.hexdigest())
+        finally:
+            if f:
+                f.close()
+        return hashes
+
+    def _hash_leaves(self, indices, hashpath=None):
+        '''Return list of leaf hashes for indices, hashed in parallel.'''
+        hashpath = self.hashpath if hashpath is None else hashpath
+        indices = list(indices)
+        if not indices:
+            return []
+        n = -(-len(indices) // self.workers)
+        ranges = [(hashpath, indices[i:i + n]) for i in range(0, len(indices), n)]
+        if len(ranges) < 2:
+            return self._hash_range((hashpath, indices))
+        pool = ThreadPool(self.workers)
+        try:
+            hashes = pool.map(self._hash_range, ranges)
+        finally:
+            pool.terminate()
+            pool.join()
+        return [x for i in hashes for x in i]
+
+    def _get_root(self):
+        level = self.leaves
+        while len(level) > 1:
+            pairs = []
+            for i in range(0, len(level) - 1, 2):
+                node = hashlib.new(self.algorithm, b'\x01')
+                node.update(binascii.unhexlify(level[i]))
+                node.update(binascii.unhexlify(level[i + 1]))
+                pairs.append(node.hexdigest())
+            if len(level) % 2:
+                pairs.append(level[-1])
+            level = pairs
+        return level[0]
+
+    def update(self, offset=0, length=None):
+        '''
+        Re-hash the leaves covering length bytes from offset (or everything
+        after offset if length is None) and recompute the root.  If the size
+        of hashpath changed, the leaf where the old and new data end is
+        re-hashed as well, along with every leaf after it, and leaves are
+        added or dropped to match.
+        '''
+        size = self._size()
+        count = self._count()
+        first = offset // self.leaf_size
+        if size != self.size:
+            first = min(first, min(size, self.size) // self.leaf_size)
+            last = count
+        elif length is None:
+            last = count
+        else:
+            last = min(count, -(-(offset + length) // self.leaf_size))
+        first = min(first, count)
+        last = max(first, last)
+        self.size = size
+        hashes = self._hash_leaves(range(first, last))
+        self.leaves = self.leaves[:first] + hashes + self.leaves[last:count]
+        self.root = self._get_root()
+        return self
+
+    def verify(self, hashpath=None):
+        '''
+        Return list of indices of leaves of hashpath (self.hashpath by
+        default) that do not match the stored leaf hashes.
+        '''
+        hashpath = self.hashpath if hashpath is None else hashpath
+        count = self._count(hashpath)
+        hashes = self._hash_leaves(range(count), hashpath)
+        changed = [i for i, x in enumerate(hashes)
+                   if i >= len(self.leaves) or self.leaves[i] != x]
+        return changed + list(range(count, len(self.leaves)))
+
+def _phash_image(image_path, hash_size, draft=False):
+    '''
+    Return image_path converted to grayscale and shrunk to
+    (hash_size + 1, hash_size).  If draft is True, JPEGs are decoded at the
+    smallest scale that is still at least that size.
+    '''
+    from PIL import Image
+    img = Image.open(image_path)
+    if draft:
+        img.draft('L', (hash_size + 1, hash_size))
+    return img.convert('L').resize((hash_size + 1, hash_size), Image.ANTIALIAS)
+
+def _phash_value(img, hash_size):
+    '''
+    Compare adjacent pixels of img and pack the comparisons into an integer,
+    eight bits per byte with the first comparison in the lowest bit of the
+    most significant byte.  Uses NumPy if it is installed.
+    '''
+    nbytes = hash_size * hash_size // 8
+    if not nbytes:
+        return 0
+    try:
+        import numpy
+    except ImportError:
+        numpy = None
+    if numpy:
+        pixels = numpy.asarray(img, dtype=numpy.int16)
+        difference = (pixels[:, :-1] > pixels[:, 1:]).flatten()
+        octets = difference[:nbytes * 8].reshape(nbytes, 8)[:, ::-1]
+        return int(binascii.hexlify(numpy.packbits(octets).tostring()), 16)
+    value = 0
+    decimal_value = 0
+    for index in range(nbytes * 8):
+        row, col = divmod(index, hash_size)
+        if img.getpixel((col, row)) > img.getpixel((col + 1, row)):
+            decimal_value += 2**(index % 8)
+        if (index % 8) == 7:
+            value = (value << 8) | decimal_value
+            decimal_value = 0
+    return value
+
+def phash_int(image_path, hash_size=8, draft=False):
+    '''
+    Return the difference hash of image_path (see phash) packed into an
+    integer, so that hashes can be compared with bit operations:
+        bin(phash_int(a) ^ phash_int(b)).count('1')
+    '''
+    img = _phash_image(image_path, hash_size, draft)
+    return _phash_value(img, hash_size)
 
 def phash(image_path, hash_size = 8):
     '''
@@ -161,28 +530,37 @@ def phash(image_path, hash_size = 8):
         - convert comparison into bits
         - return hash of bits (hexadecimal string)
     '''
-    from PIL import Image
-    # Grayscale and shrink the image in one step.
-    img = Image.open(image_path)
-    img = img.convert('L').resize((hash_size + 1, hash_size), Image.ANTIALIAS,)
-    # Compare adjacent pixels.
-    difference = []
-    for row in xrange(hash_size):
-        for col in xrange(hash_size):
-            pixel_left = img.getpixel((col, row))
-            pixel_right = img.getpixel((col + 1, row))
-            difference.append(pixel_left > pixel_right)
-    # Convert the binary array to a hexadecimal string.
-    decimal_value = 0
-    hex_string = []
-    for index, value in enumerate(difference):
-        if value:
-            decimal_value += 2**(index % 8)
-        if (index % 8) == 7:
-            hex_string.append(hex(decimal_value)[2:].rjust(2, '0'))
-            decimal_value = 0
- 
-    return ''.join(hex_string)
+    nbytes = hash_size * hash_size // 8
+    if not nbytes:
+        return ''
+    return '%0*x'%(nbytes * 2, phash_int(image_path, hash_size))
+
+def _phash_batch_item(args):
+    '''Return (image_path, phash_int) for phash_batch pool workers.'''
+    image_path, hash_size, draft = args
+    try:
+        return image_path, phash_int(image_path, hash_size, draft)
+    except (IOError, ValueError):
+        return image_path, None
+
+def phash_batch(image_paths, hash_size=8, workers=None, draft=True):
+    '''
+    Return dictionary of image path: phash_int for every path in
+    image_paths.  Images are decoded by a pool of worker processes
+    (workers=None uses one per CPU) and, since draft is True by default,
+    JPEGs are only decoded at the scale needed for the hash.  Images that
+    cannot be opened are mapped to None.
+    '''
+    from multiprocessing import Pool
+    items = [(x, hash_size, draft) for x in image_paths]
+    pool = Pool(workers)
+    try:
+        hashes = dict(pool.imap_unordered(_phash_batch_item, items, 32))
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+    return hashes
    
 def encrypt(key, data, replace=True, hash_key='', prefix='', suffix='_lock'):
     '''
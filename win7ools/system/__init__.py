@@ -4,26 +4,41 @@
 import _winreg as reg
 import cPickle
 import ctypes
+import hashlib
 import multiprocessing as multi
 import os
 import os.path as path
 import platform
 import re
+import sqlite3
 import string
 import subprocess
+import tempfile
 import time
 from collections import defaultdict
+from itertools import groupby
 from distutils.log import warn
+from functools import partial
+from multiprocessing.pool import ThreadPool
 from PIL import Image
 from subprocess import call
+from win7ools.lib import BKTree
 from win7ools.lib import img_loads
 from win7ools.lib import log
+from win7ools.lib import search
 from win7ools.lib import truncate
 from win7ools.ipl import IPL
 from win7ools.reg import get_values as values
 from win7ools.reg import RegistryKeys
 from win7ools.reg import LOCAL_MACHINE, CLASSES_ROOT, CURRENT_USER, ALL_ACCESS
-from win7ools.sec import md5
+from win7ools.sec import chunks, md5, phash_batch, phash_int
+try:
+    from os import scandir
+except ImportError:
+    from scandir import scandir
+
+SAMPLE_SIZE = 4096
+IMAGE_EXTENSIONS = ['.bmp', '.gif', '.jpeg', '.jpg', '.png', '.tif', '.tiff']
 
 class Metadata(object):
     '''
@@ -620,33 +635,427 @@ def set_monitor_power(state='off'):
     state = 1 if state.lower() == 'on' else 2
     SendMessage(65535, 274, 61808, state)
 
-def get_rainbow_table(dirpath, hashfunc):
+class HashCache(object):
+    '''
+    sqlite3 database of file hashes used by get_rainbow_table and
+    get_duplicate_files to avoid hashing unchanged files again.
+
+    A cached hash is used while the size, modification time and inode of
+    the file match the values recorded when it was hashed.  On Windows,
+    the inode (file index) is read with os.stat, since DirEntry.stat
+    always reports 0 there; Python 2 reports 0 from os.stat as well, so
+    only size and modification time are checked there.  If trust_dirs
+    is True, directories whose modification time has not changed are not
+    listed again; their files are taken from the cache.  This is much
+    faster on mostly static trees, but in-place edits that do not change
+    the directory itself are missed.
+
+    ex:
+        >> cache = HashCache()
+        >> get_duplicate_files('D:\\Archive', cache=cache)
+    '''
+    def __init__(self, db_path='', trust_dirs=False):
+        if not db_path:
+            db_path = path.join(os.path.dirname(__file__), 'hashes.db')
+        self.db_path = db_path
+        self.trust_dirs = trust_dirs
+        self.conn = sqlite3.connect(db_path)
+        self.conn.text_factory = str
+        c = self.conn.cursor()
+        c.execute('CREATE TABLE IF NOT EXISTS dirs('
+                  'path PRIMARY KEY, parent, mtime)')
+        c.execute('CREATE TABLE IF NOT EXISTS entries('
+                  'path PRIMARY KEY, parent, size, mtime, inode)')
+        c.execute('CREATE TABLE IF NOT EXISTS hashes('
+                  'path, hashfunc, size, mtime, inode, digest, '
+                  'PRIMARY KEY (path, hashfunc))')
+        c.execute('CREATE TABLE IF NOT EXISTS trees('
+                  'path, hashfunc, fingerprint, '
+                  'PRIMARY KEY (path, hashfunc))')
+        c.execute('CREATE INDEX IF NOT EXISTS dirs_parent ON dirs(parent)')
+        c.execute('CREATE INDEX IF NOT EXISTS entries_parent '
+                  'ON entries(parent)')
+        self.conn.commit()
+
+    def __repr__(self):
+        return 'HashCache(%r)'%self.db_path
+
+    def close(self):
+        self.conn.close()
+
+    def commit(self):
+        self.conn.commit()
+
+    def walk(self, dirpath):
+        '''
+        Yield (path, size) of every file in dirpath and its subdirectories,
+        recording each directory listing in the cache.  dirpath is made
+        absolute and normalized, so every spelling of it shares one record.
+        '''
+        dirpath = path.normpath(path.abspath(dirpath))
+        for i in self._walk(dirpath):
+            yield i
+        self.commit()
+
+    def _walk(self, dirpath):
+        if not path.isdir(dirpath):
+            return
+        c = self.conn.cursor()
+        mtime = os.stat(dirpath).st_mtime
+        row = c.execute('SELECT mtime FROM dirs WHERE path=?',
+                        (dirpath,)).fetchone()
+        if self.trust_dirs and row and row[0] == mtime:
+            files = c.execute('SELECT path, size FROM entries WHERE parent=?',
+                              (dirpath,)).fetchall()
+            subdirs = [x[0] for x in c.execute('SELECT path FROM dirs '
+                                               'WHERE parent=?', (dirpath,))]
+        else:
+            files, subdirs, rows = [], [], []
+            for entry in scandir(dirpath):
+                if entry.is_file():
+                    st = entry.stat()
+                    files.append((entry.path, st.st_size))
+                    rows.append((entry.path, dirpath, st.st_size,
+                                 st.st_mtime, _inode(entry)))
+                elif entry.is_dir():
+                    subdirs.append(entry.path)
+            old = [x[0] for x in c.execute('SELECT path FROM dirs '
+                                           'WHERE parent=?', (dirpath,))]
+            for removed in set(old) - set(subdirs):
+                self.forget(removed)
+            #hashes of files that are no longer in dirpath are dropped
+            listed = [x[0] for x in c.execute('SELECT path FROM entries '
+                                              'WHERE parent=?', (dirpath,))]
+            removed = set(listed) - set(x[0] for x in files)
+            c.executemany('DELETE FROM hashes WHERE path=?',
+                          [(x,) for x in removed])
+            c.execute('DELETE FROM entries WHERE parent=?', (dirpath,))
+            c.executemany('INSERT INTO entries VALUES (?, ?, ?, ?, ?)', rows)
+            #NULL mtime makes sure interrupted subdirectories are listed
+            c.executemany('INSERT OR IGNORE INTO dirs VALUES (?, ?, NULL)',
+                          [(x, dirpath) for x in subdirs])
+            c.execute('INSERT OR REPLACE INTO dirs VALUES (?, ?, ?)',
+                      (dirpath, path.dirname(dirpath), mtime))
+        for i in files:
+            yield i
+        for subdir in subdirs:
+            for i in self._walk(subdir):
+                yield i
+
+    def forget(self, dirpath):
+        '''Remove dirpath and everything below it from the cache.'''
+        prefix = path.join(dirpath, '')
+        n = len(prefix)
+        c = self.conn.cursor()
+        for table in ['dirs', 'entries', 'hashes', 'trees']:
+            c.execute('DELETE FROM %s WHERE path=? OR substr(path, 1, ?)=?'
+                      %table, (dirpath, n, prefix))
+
+    def subdirs(self, dirpath):
+        '''Return dirpath and the directories below it listed by walk.'''
+        prefix = path.join(dirpath, '')
+        rows = self.conn.execute('SELECT path FROM dirs WHERE path=? '
+                                 'OR substr(path, 1, ?)=?',
+                                 (dirpath, len(prefix), prefix))
+        return [x[0] for x in rows]
+
+    def fingerprints(self, dirpath, hashfunc):
+        '''
+        Return (trees, digests) stored by store_fingerprints for dirpath,
+        where trees maps directories and digests maps files to their
+        fingerprints.  Both are empty if dirpath was never stored.
+        '''
+        prefix = path.join(dirpath, '')
+        args = (_hashfunc_name(hashfunc), dirpath, len(prefix), prefix)
+        where = 'WHERE hashfunc=? AND (path=? OR substr(path, 1, ?)=?)'
+        trees = dict(self.conn.execute('SELECT path, fingerprint FROM trees '
+                                       + where, args))
+        if dirpath not in trees:
+            return {}, {}
+        #only digests of files still listed in entries and unchanged since
+        #they were hashed, as in lookup
+        digests = dict(self.conn.execute(
+            'SELECT h.path, h.digest FROM hashes h '
+            'JOIN entries e ON h.path = e.path '
+            'WHERE h.hashfunc=? AND (h.path=? OR substr(h.path, 1, ?)=?) '
+            'AND h.size=e.size AND h.mtime=e.mtime AND h.inode=e.inode',
+            args))
+        return trees, digests
+
+    def store_fingerprints(self, dirpath, hashfunc, trees):
+        '''Replace the directory fingerprints stored for dirpath.'''
+        name = _hashfunc_name(hashfunc)
+        prefix = path.join(dirpath, '')
+        self.conn.execute('DELETE FROM trees WHERE hashfunc=? AND '
+                          '(path=? OR substr(path, 1, ?)=?)',
+                          (name, dirpath, len(prefix), prefix))
+        self.conn.executemany('INSERT INTO trees VALUES (?, ?, ?)',
+                              ((k, name, v) for k, v in trees.items()))
+        self.commit()
+
+    def lookup(self, pathName, hashfunc):
+        '''Return cached hash of pathName if the file is unchanged.'''
+        row = self.conn.execute('SELECT h.digest FROM hashes h '
+                                'JOIN entries e ON h.path = e.path '
+                                'WHERE h.path=? AND h.hashfunc=? '
+                                'AND h.size=e.size AND h.mtime=e.mtime '
+                                'AND h.inode=e.inode',
+                                (pathName, _hashfunc_name(hashfunc)))
+        row = row.fetchone()
+        return row[0] if row else None
+
+    def store(self, pathName, hashfunc, digest):
+        '''Record digest for pathName as listed by the last walk.'''
+        self.conn.execute('INSERT OR REPLACE INTO hashes '
+                          'SELECT path, ?, size, mtime, inode, ? '
+                          'FROM entries WHERE path=?',
+                          (_hashfunc_name(hashfunc), digest, pathName))
+
+def _inode(entry):
+    '''Return inode of os.DirEntry, which DirEntry.stat leaves 0 on Windows.'''
+    if os.name == 'nt':
+        return os.stat(entry.path).st_ino
+    return entry.stat().st_ino
+
+def _hashfunc_name(hashfunc):
+    return '%s.%s'%(hashfunc.__module__, hashfunc.__name__)
+
+def walk_entries(dirpath):
+    '''Yield os.DirEntry of every file in dirpath and its subdirectories.'''
+    if path.exists(dirpath):
+        for entry in scandir(dirpath):
+            if entry.is_file():
+                yield entry
+            elif entry.is_dir():
+                for i in walk_entries(entry.path):
+                    yield i
+
+def walk_files(dirpath):
+    '''Yield absolute path of every file in dirpath and its subdirectories.'''
+    for entry in walk_entries(dirpath):
+        yield entry.path
+
+def _hash_file(args):
+    '''Return (pathName, hashfunc(pathName)) for pool workers.'''
+    hashfunc, pathName = args
+    return pathName, hashfunc(pathName)
+
+def hash_files(paths, hashfunc, workers=1, processes=False):
+    '''
+    Yield (path, hashfunc(path)) for each path in paths.
+
+    If workers > 1, files are hashed by a pool of threads (or processes if
+    processes=True) and pairs are yielded as they complete.  Threads are
+    usually enough since hashlib releases the GIL on large buffers; with
+    processes=True, hashfunc must be picklable (a module-level function).
+    workers=None uses one worker per CPU.
+    '''
+    if workers is None:
+        workers = multi.cpu_count()
+    if workers > 1:
+        if processes:
+            pool = multi.Pool(workers)
+            chunksize = 16
+        else:
+            pool = ThreadPool(workers)
+            chunksize = 1
+        try:
+            items = ((hashfunc, pathName) for pathName in paths)
+            for i in pool.imap_unordered(_hash_file, items, chunksize):
+                yield i
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+    else:
+        for pathName in paths:
+            yield pathName, hashfunc(pathName)
+
+def get_hashes(paths, hashfunc, cache, workers=1, processes=False):
+    '''
+    Return dictionary of path: hashfunc(path) for each path in paths.
+    Only files that are new or changed since they were stored in cache
+    (a HashCache that has walked them) are hashed.
+    '''
+    table = {}
+    missing = []
+    for pathName in paths:
+        digest = cache.lookup(pathName, hashfunc)
+        if digest is None:
+            missing.append(pathName)
+        else:
+            table[pathName] = digest
+    for pathName, digest in hash_files(missing, hashfunc, workers, processes):
+        table[pathName] = digest
+        cache.store(pathName, hashfunc, digest)
+    cache.commit()
+    return table
+
+def _is_file(entry):
+    return entry.is_file()
+
+def walk_checkpoint(dirpath, checkpoint, cache=None):
+    '''
+    Return list of (path, size) of every file in dirpath.  The walk is
+    saved in checkpoint (a lib.Checkpoint) and resumed from it, or taken
+    from cache.walk if cache is a HashCache.  Once the walk is done, the
+    listing is stored once in a file of its own (Checkpoint.store) and
+    removed from the state, so later saves do not write it again.
+    '''
+    if cache:
+        return list(cache.walk(dirpath))
+    files = checkpoint.restore('files')
+    if files is None:
+        if not path.exists(dirpath):
+            return []
+        #same rules as walk_entries: follow links, raise if unreadable
+        paths = search(_is_file, dirpath, checkpoint=checkpoint,
+                       follow_symlinks=True, ignore_errors=False)
+        files = [(x, path.getsize(x)) for x in paths]
+        checkpoint.store('files', files)
+        checkpoint.state.pop('search', None)
+        checkpoint.save()
+    return files
+
+def get_checkpoint_hashes(paths, hashfunc, checkpoint, workers=1,
+                          processes=False, cache=None):
+    '''
+    Return dictionary of path: hashfunc(path) for each path in paths,
+    like get_hashes, keeping the digests in checkpoint (a lib.Checkpoint).
+    Files hashed before an interrupted run are not hashed again.
+    '''
+    digests = checkpoint.state.setdefault('digests', {})
+    missing = []
+    for pathName in paths:
+        if pathName in digests:
+            continue
+        digest = cache.lookup(pathName, hashfunc) if cache else None
+        if digest is None:
+            missing.append(pathName)
+        else:
+            digests[pathName] = digest
+    try:
+        for pathName, digest in hash_files(missing, hashfunc, workers,
+                                           processes):
+            digests[pathName] = digest
+            if cache:
+                cache.store(pathName, hashfunc, digest)
+            checkpoint.tick()
+    except KeyboardInterrupt:
+        checkpoint.save()
+        raise
+    finally:
+        if cache:
+            cache.commit()
+    return dict((x, digests[x]) for x in paths)
+
+def get_rainbow_table(dirpath, hashfunc, workers=1, processes=False,
+                      cache=None, checkpoint=None):
     '''
     Return dictionary with:
     --key: absolute path to file
     --value: hash of file using hashfunc
+
+    The directory walk is fed straight to hash_files, so with workers > 1
+    several files are read and hashed while the walk continues.
+    If cache is a HashCache, only new or changed files are hashed.
+    If checkpoint is a lib.Checkpoint, the walk and the hashes are saved
+    in it and an interrupted run resumes from it (see walk_checkpoint and
+    get_checkpoint_hashes); it is cleared once the table is complete.
     '''
-    def get_rainbow(dirpath):
-        if path.exists(dirpath):
-            for i in os.listdir(dirpath):
-                pathName = '%s\\%s'%(dirpath, i)
-                if path.isfile(pathName):
-                    yield {pathName: hashfunc(pathName)}
-                else:
-                    for i in get_rainbow(pathName):
-                        yield i
-    table = {}
-    for i in get_rainbow(dirpath):
-        table.update(i)
-    return table
+    if checkpoint is not None:
+        files = walk_checkpoint(dirpath, checkpoint, cache)
+        paths = [pathName for pathName, size in files]
+        table = get_checkpoint_hashes(paths, hashfunc, checkpoint, workers,
+                                      processes, cache)
+        checkpoint.clear()
+        return table
+    if cache:
+        paths = [pathName for pathName, size in cache.walk(dirpath)]
+        return get_hashes(paths, hashfunc, cache, workers, processes)
+    paths = walk_files(dirpath)
+    return dict(hash_files(paths, hashfunc, workers, processes))
 
-def get_duplicate_files(dirpath, hashfunc=md5):
+def get_sample_hash(pathName, size, sample_size=SAMPLE_SIZE):
+    '''
+    Return MD5 of the first and last sample_size bytes of file at pathName.
+    Used to rule out same-sized files without reading them in full.
+    '''
+    sample = hashlib.md5()
+    with open(pathName, 'rb') as f:
+        sample.update(f.read(sample_size))
+        f.seek(max(size - sample_size, 0))
+        sample.update(f.read(sample_size))
+    return sample.hexdigest()
+
+def get_duplicate_candidates(dirpath, sample_size=SAMPLE_SIZE, cache=None,
+                             checkpoint=None):
+    '''
+    Return nested list of absolute paths of files in dirpath that might be
+    duplicates. Files are grouped by size, then groups of files larger than
+    two samples are split by get_sample_hash.  Files with a unique size or
+    a unique sample are never read in full.
+    If cache is a HashCache, the directory listing is taken from cache.walk.
+    If checkpoint is a lib.Checkpoint, the walk and the candidates are
+    saved in it (see walk_checkpoint).
+    '''
+    if checkpoint is not None and 'candidates' in checkpoint.state:
+        return checkpoint.state['candidates']
+    candidates = []
+    sizes = defaultdict(list)
+    if checkpoint is not None:
+        files = walk_checkpoint(dirpath, checkpoint, cache)
+    elif cache:
+        files = cache.walk(dirpath)
+    else:
+        files = ((x.path, x.stat().st_size) for x in walk_entries(dirpath))
+    for pathName, size in files:
+        sizes[size].append(pathName)
+    for size, paths in sizes.items():
+        if len(paths) < 2:
+            continue
+        if size <= 2 * sample_size:
+            candidates.append(paths)
+            continue
+        samples = defaultdict(list)
+        for pathName in paths:
+            samples[get_sample_hash(pathName, size, sample_size)].append(pathName)
+        candidates.extend([x for x in samples.values() if len(x) > 1])
+    if checkpoint is not None:
+        checkpoint.state['candidates'] = candidates
+        checkpoint.save()
+    return candidates
+
+def get_duplicate_files(dirpath, hashfunc=md5, staged=True,
+                        workers=1, processes=False, cache=None,
+                        checkpoint=None):
     '''
     Return nested list of absolute paths of duplicate files in dirpath.
+
+    If staged is True, hashfunc is only used on files returned by
+    get_duplicate_candidates, otherwise every file in dirpath is hashed.
+    workers and processes are passed to hash_files.
+    If cache is a HashCache, unchanged files are not hashed again.
+    If checkpoint is a lib.Checkpoint, an interrupted run resumes from it;
+    it is cleared once the duplicates are found.
     '''
     duplicates = []
-    inverse = defaultdict(list) 
-    data = get_rainbow_table(dirpath, hashfunc) 
+    inverse = defaultdict(list)
+    if staged:
+        groups = get_duplicate_candidates(dirpath, cache=cache,
+                                          checkpoint=checkpoint)
+        paths = [pathName for group in groups for pathName in group]
+        if checkpoint is not None:
+            data = get_checkpoint_hashes(paths, hashfunc, checkpoint, workers,
+                                         processes, cache)
+            checkpoint.clear()
+        elif cache:
+            data = get_hashes(paths, hashfunc, cache, workers, processes)
+        else:
+            data = dict(hash_files(paths, hashfunc, workers, processes))
+    else:
+        data = get_rainbow_table(dirpath, hashfunc, workers, processes,
+                                 cache, checkpoint)
     for k, v in data.items():
         inverse[v].append(k)
     for i in inverse.items():
@@ -654,6 +1063,305 @@ def get_duplicate_files(dirpath, hashfunc=md5):
             duplicates.append(i[1])
     return duplicates
     
+def iter_duplicate_files(dirpath, hashfunc=md5, db_path='', workers=1,
+                         processes=False, sample_size=SAMPLE_SIZE,
+                         batch_size=10000):
+    '''
+    Yield lists of absolute paths of duplicate files in dirpath.
+
+    Works like get_duplicate_files, but (size, digest, path) records are
+    written to an sqlite3 database (a temporary file unless db_path is
+    given) and grouped there with an index.  Memory use does not grow
+    with the number of files; only one group of same-sized files and
+    batch_size paths waiting to be hashed are held at a time.
+    '''
+    temporary = not db_path
+    if temporary:
+        fd, db_path = tempfile.mkstemp(suffix='.db')
+        os.close(fd)
+    conn = sqlite3.connect(db_path)
+    conn.text_factory = str
+    def insert_digests(sizes):
+        items = hash_files(list(sizes), hashfunc, workers, processes)
+        conn.executemany('INSERT INTO digests VALUES (?, ?, ?)',
+                         ((sizes[x], digest, x) for x, digest in items))
+    try:
+        c = conn.cursor()
+        c.execute('DROP TABLE IF EXISTS files')
+        c.execute('DROP TABLE IF EXISTS digests')
+        c.execute('CREATE TABLE files(size, path)')
+        c.execute('CREATE TABLE digests(size, digest, path)')
+        c.executemany('INSERT INTO files VALUES (?, ?)',
+                      ((x.stat().st_size, x.path) for x in walk_entries(dirpath)))
+        c.execute('CREATE INDEX files_size ON files(size)')
+        conn.commit()
+        c.execute('SELECT size, path FROM files WHERE size IN '
+                  '(SELECT size FROM files GROUP BY size HAVING count(*) > 1) '
+                  'ORDER BY size')
+        sizes = {}
+        for size, rows in groupby(c, lambda x: x[0]):
+            paths = [x[1] for x in rows]
+            if size > 2 * sample_size:
+                samples = defaultdict(list)
+                for pathName in paths:
+                    sample = get_sample_hash(pathName, size, sample_size)
+                    samples[sample].append(pathName)
+                paths = [x for group in samples.values() if len(group) > 1
+                         for x in group]
+            for pathName in paths:
+                sizes[pathName] = size
+            if len(sizes) >= batch_size:
+                insert_digests(sizes)
+                sizes = {}
+        insert_digests(sizes)
+        c.execute('CREATE INDEX digests_key ON digests(size, digest)')
+        conn.commit()
+        c.execute('SELECT size, digest, path FROM digests ORDER BY size, digest')
+        for key, rows in groupby(c, lambda x: x[:2]):
+            paths = [x[2] for x in rows]
+            if len(paths) > 1:
+                yield paths
+    finally:
+        conn.close()
+        if temporary:
+            os.remove(db_path)
+
+def _chunk_list(pathName, min_size, avg_size, max_size):
+    '''Return list of (length, digest) of the chunks of pathName.'''
+    return [(length, digest) for offset, length, digest
+            in chunks(pathName, min_size, avg_size, max_size)]
+
+def get_dedup_report(dirpath, min_size=2048, avg_size=8192, max_size=65536,
+                     workers=1):
+    '''
+    Split every file in dirpath into content-defined chunks (sec.chunks)
+    and return dictionary describing how much data is shared:
+    {
+    'files': number of files,
+    'chunks': number of chunks,
+    'unique_chunks': number of distinct chunks,
+    'total_bytes': size of all files,
+    'unique_bytes': bytes left after storing each distinct chunk once,
+    'shared_bytes': total_bytes - unique_bytes
+    }
+    With workers > 1, files are chunked by a pool of processes.
+    '''
+    chunk_list = partial(_chunk_list, min_size=min_size, avg_size=avg_size,
+                         max_size=max_size)
+    report = dict.fromkeys(['files', 'chunks', 'unique_chunks',
+                            'total_bytes', 'unique_bytes'], 0)
+    seen = set()
+    paths = walk_files(dirpath)
+    for pathName, items in hash_files(paths, chunk_list, workers, True):
+        report['files'] += 1
+        for length, digest in items:
+            report['chunks'] += 1
+            report['total_bytes'] += length
+            if digest not in seen:
+                seen.add(digest)
+                report['unique_chunks'] += 1
+                report['unique_bytes'] += length
+    report['shared_bytes'] = report['total_bytes'] - report['unique_bytes']
+    return report
+
+def _get_tree(dirpath, hashfunc, workers, processes, cache, refresh):
+    '''Return (trees, digests) for get_tree_fingerprints and compare_trees.'''
+    dirpath = path.normpath(path.abspath(dirpath))
+    if cache and not refresh:
+        trees, digests = cache.fingerprints(dirpath, hashfunc)
+        if trees:
+            return trees, digests
+    if cache:
+        sizes = dict(cache.walk(dirpath))
+        dirs = cache.subdirs(dirpath)
+        digests = get_hashes(sizes, hashfunc, cache, workers, processes)
+    else:
+        sizes = {}
+        dirs = [dirpath] if path.isdir(dirpath) else []
+        for d in dirs:
+            for entry in scandir(d):
+                if entry.is_file():
+                    sizes[entry.path] = entry.stat().st_size
+                elif entry.is_dir():
+                    dirs.append(entry.path)
+        digests = dict(hash_files(sizes, hashfunc, workers, processes))
+    children = defaultdict(list)
+    for pathName, size in sizes.items():
+        children[path.dirname(pathName)].append('f\0%s\0%d\0%s\n'%(
+            path.basename(pathName), size, digests[pathName]))
+    trees = {}
+    #children always have longer paths than their parents
+    for d in sorted(dirs, key=len, reverse=True):
+        trees[d] = hashlib.sha1(''.join(sorted(children[d]))).hexdigest()
+        if d != dirpath:
+            children[path.dirname(d)].append('d\0%s\0%s\n'%(
+                path.basename(d), trees[d]))
+    if cache:
+        cache.store_fingerprints(dirpath, hashfunc, trees)
+    return trees, digests
+
+def get_tree_fingerprints(dirpath, hashfunc=md5, workers=1, processes=False,
+                          cache=None, refresh=True):
+    '''
+    Return dictionary with:
+    --key: absolute path of dirpath and every directory below it
+    --value: SHA1 of the names, sizes and hashfunc digests of the files
+             in the directory and the names and fingerprints of its
+             subdirectories
+    Directories with the same fingerprint have identical contents.
+    If cache is a HashCache, only new or changed files are hashed and the
+    fingerprints are stored in cache.  With refresh=False, fingerprints
+    already stored for dirpath are returned without walking it.
+    '''
+    return _get_tree(dirpath, hashfunc, workers, processes, cache, refresh)[0]
+
+def _tree_children(trees, digests):
+    children = defaultdict(dict)
+    for pathName in list(trees) + list(digests):
+        children[path.dirname(pathName)][path.basename(pathName)] = pathName
+    return children
+
+def compare_trees(src, dst, hashfunc=md5, workers=1, processes=False,
+                  cache=None, refresh=True):
+    '''
+    Compare directories src and dst by their fingerprints and return
+    dictionary of lists of paths relative to src and dst:
+    --added: only in src
+    --removed: only in dst
+    --changed: files with different contents (or a file in one tree and a
+               directory in the other)
+    --same: identical directories, which are not descended into
+    cache and refresh are passed to get_tree_fingerprints.
+    ex: compare_trees('C:/Projects', 'E:/Backup/Projects')
+    '''
+    src = path.normpath(path.abspath(src))
+    dst = path.normpath(path.abspath(dst))
+    trees_a, files_a = _get_tree(src, hashfunc, workers, processes, cache,
+                                 refresh)
+    trees_b, files_b = _get_tree(dst, hashfunc, workers, processes, cache,
+                                 refresh)
+    children_a = _tree_children(trees_a, files_a)
+    children_b = _tree_children(trees_b, files_b)
+    result = {'added': [], 'removed': [], 'changed': [], 'same': []}
+    stack = [('', src, dst)]
+    while stack:
+        rel, a, b = stack.pop()
+        if trees_a.get(a) == trees_b.get(b):
+            result['same'].append(rel)
+            continue
+        names_a, names_b = children_a[a], children_b[b]
+        for name in sorted(set(names_a) | set(names_b)):
+            x, y = names_a.get(name), names_b.get(name)
+            relpath = path.join(rel, name) if rel else name
+            if y is None:
+                result['added'].append(relpath)
+            elif x is None:
+                result['removed'].append(relpath)
+            elif x in trees_a and y in trees_b:
+                stack.append((relpath, x, y))
+            elif x not in files_a or files_a[x] != files_b.get(y):
+                result['changed'].append(relpath)
+    return result
+
+def get_duplicate_dirs(dirpath, hashfunc=md5, workers=1, processes=False,
+                       cache=None):
+    '''
+    Return nested list of absolute paths of directories in dirpath with
+    identical contents (see get_tree_fingerprints).  Empty directories and
+    directories inside a duplicated parent are not listed.
+    '''
+    trees = get_tree_fingerprints(dirpath, hashfunc, workers, processes, cache)
+    empty = hashlib.sha1('').hexdigest()
+    inverse = defaultdict(list)
+    for k, v in trees.items():
+        if v != empty:
+            inverse[v].append(k)
+    duplicated = set(k for v in inverse.values() if len(v) > 1 for k in v)
+    duplicates = []
+    for paths in inverse.values():
+        parents = set(trees.get(path.dirname(x)) for x in paths)
+        inside = (len(parents) == 1 and
+                  all(path.dirname(x) in duplicated for x in paths))
+        if len(paths) > 1 and not inside:
+            duplicates.append(sorted(paths))
+    return duplicates
+
+class ImageIndex(object):
+    '''
+    Index of image difference hashes (sec.phash_int) kept in a BKTree, for
+    finding images that look alike even if their bytes differ.
+
+    ex:
+        >> index = ImageIndex(walk_images('D:\\Pictures'))
+        >> index.query('D:\\Pictures\\beach.jpg', distance=4)
+        >> index.clusters()
+    '''
+    def __init__(self, image_paths=(), hash_size=8, workers=None):
+        self.hash_size = hash_size
+        self.workers = workers
+        self.paths = defaultdict(list)
+        self.tree = BKTree()
+        self.add(image_paths)
+
+    def __len__(self):
+        return sum(len(x) for x in self.paths.values())
+
+    def add(self, image_paths):
+        '''Hash and index image_paths with sec.phash_batch.'''
+        image_paths = list(image_paths)
+        if image_paths:
+            hashes = phash_batch(image_paths, self.hash_size, self.workers)
+            for image_path, value in hashes.items():
+                if value is None:
+                    continue
+                if value not in self.paths:
+                    self.tree.add(value)
+                self.paths[value].append(image_path)
+        return self
+
+    def query(self, image_path, distance=4):
+        '''
+        Return list of indexed image paths whose hash is within distance
+        bits of the hash of image_path, closest first.
+        '''
+        value = phash_int(image_path, self.hash_size, draft=True)
+        found = sorted(self.tree.query(value, distance))
+        return [x for d, match in found for x in self.paths[match]]
+
+    def clusters(self, distance=4):
+        '''
+        Return nested list of image paths that are linked by a chain of
+        hashes at most distance bits apart.  Each hash is queried against the
+        tree once, so no all-pairs comparison is made.
+        '''
+        parent = dict((x, x) for x in self.paths)
+        def root(x):
+            while parent[x] != x:
+                parent[x] = parent[parent[x]]
+                x = parent[x]
+            return x
+        for value in self.paths:
+            for d, match in self.tree.query(value, distance):
+                parent[root(match)] = root(value)
+        groups = defaultdict(list)
+        for value, paths in self.paths.items():
+            groups[root(value)].extend(paths)
+        return [x for x in groups.values() if len(x) > 1]
+
+def walk_images(dirpath, extensions=IMAGE_EXTENSIONS):
+    '''Yield absolute path of every image file in dirpath and its subdirectories.'''
+    for pathName in walk_files(dirpath):
+        if path.splitext(pathName)[1].lower() in extensions:
+            yield pathName
+
+def get_similar_images(dirpath, distance=4, hash_size=8, workers=None):
+    '''
+    Return nested list of absolute paths of images in dirpath whose
+    difference hashes are within distance bits of each other.
+    '''
+    index = ImageIndex(walk_images(dirpath), hash_size, workers)
+    return index.clusters(distance)
+
 if __name__ == '__main__':
     import doctest
     doctest.testmod(verbose=True)
\ No newline at end of file